@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+
+import numpy as np
+
+import frame_io
+import profile_table
+
+# Strong and weak scaling sweep of main.py on the CPU backend. Every run
+# is a separate mpiexec launch that writes its own profile.jsonl; the
+# per-phase reports of the frames after the first (kernel compilation) are
+# turned into seconds per substep.
+#   strong: the same --particles for every rank count
+#   weak:   --per-rank particles on every rank
+#   stale:  --particles with lockstep halos against --staleness substeps of
+#           halo staleness; drift is the share of particles the stale run
+#           puts in other grid cells than the lockstep one at the last frame
+# usage: python bench.py --ranks 1 2 4 --modes strong weak --out bench
+
+
+def run(mode, ranks, particles, args, options=(), output=False):
+    name = '{}-{}'.format(mode, ranks)
+    profile_path = os.path.join(args.out, name + '.jsonl')
+    frames = ['--output-format', 'mpiio', '--output-dir', os.path.join(args.out, name)] if output \
+        else ['--output-format', 'none']
+    command = shlex.split(args.mpiexec) + ['-n', str(ranks), sys.executable, '-u', 'main.py',
+                                           '--arch', args.arch,
+                                           '--particles', str(particles),
+                                           '--grid', str(args.grid),
+                                           '--frames', str(args.frames),
+                                           '--substeps', str(args.substeps),
+                                           '--decomposition', args.decomposition,
+                                           '--checkpoint-interval', '0',
+                                           '--profile-path', profile_path] + frames + list(options) + args.extra
+    print(' '.join(command), flush=True)
+    with open(os.path.join(args.out, name + '.log'), 'w') as log:
+        subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    with open(profile_path) as f:
+        summary = [json.loads(line) for line in f if '"summary"' in line][-1]
+    reports = profile_table.load_reports(profile_path, args.skip)
+    substeps = sum(report['substeps'] for report in reports)
+    phases = {name: {'mean': sum(report[name]['mean'] for report in reports) / substeps,
+                     'max': sum(report[name]['max'] for report in reports) / substeps}
+              for name in profile_table.phase_names(reports[0])}
+    result = {'mode': mode, 'ranks': ranks, 'particles': particles, 'grid': args.grid,
+              'frames': args.frames, 'substeps': args.substeps, 'wall': summary['wall'],
+              'substep': sum(report['wall']['max'] for report in reports) / substeps,
+              'imbalance': max(report['particles']['imbalance'] for report in reports),
+              'phases': phases}
+    if 'halo_stale' in reports[0]:
+        # halo strips run on an estimate per rank and substep, worst error
+        result['halo_stale'] = sum(report['halo_stale']['mean'] for report in reports) / substeps
+        result['halo_error'] = max(report['halo_error']['max'] for report in reports)
+    return result
+
+
+def drift(directory, reference, frame, grid):
+    # share of particles that would have to move to another cell to turn
+    # one frame's cell occupancy into the other's
+    counts = []
+    for path in (directory, reference):
+        data, _ = frame_io.read_frame(path, 'mpiio', frame)
+        counts.append(np.histogram2d(data[:, 0], data[:, 1], bins=grid, range=[[0, 1], [0, 1]])[0])
+    return 0.5 * np.abs(counts[0] - counts[1]).sum() / max(counts[1].sum(), 1)
+
+
+def stale(ranks, args):
+    sync = run('sync', ranks, args.particles, args, ['--halo-staleness', '0'], output=True)
+    result = run('stale', ranks, args.particles, args, ['--halo-staleness', str(args.staleness)], output=True)
+    result['staleness'] = args.staleness
+    result['sync_substep'] = sync['substep']
+    result['speedup'] = sync['substep'] / result['substep']
+    result['drift'] = drift(os.path.join(args.out, 'stale-{}'.format(ranks)),
+                            os.path.join(args.out, 'sync-{}'.format(ranks)), args.frames - 1, args.grid)
+    return result
+
+
+def scaling(results):
+    # speedup and efficiency against the smallest rank count of each mode;
+    # weak scaling is efficient when the time per substep stays flat
+    for mode in ('strong', 'weak'):
+        runs = [result for result in results if result['mode'] == mode]
+        if not runs:
+            continue
+        base = min(runs, key=lambda result: result['ranks'])
+        for result in runs:
+            speedup = base['substep'] / result['substep']
+            result['speedup'] = speedup
+            if mode == 'strong':
+                result['efficiency'] = speedup * base['ranks'] / result['ranks']
+            else:
+                result['efficiency'] = speedup
+
+
+def markdown(results):
+    scaled = [result for result in results if result['mode'] != 'stale']
+    stale_runs = [result for result in results if result['mode'] == 'stale']
+    lines = []
+    if scaled:
+        lines += scaling_table(scaled)
+    if stale_runs:
+        if lines:
+            lines.append('')
+        lines += ['| ranks | staleness | lockstep substep (secs) | stale substep (secs) | speedup '
+                  '| stale halos per substep | halo error | drift |',
+                  '| --- ' * 8 + '|']
+        for result in stale_runs:
+            lines.append('| {} | {} | {:.3g} | {:.3g} | {:.2f} | {:.2f} | {:.3g} | {:.4f} |'.format(
+                result['ranks'], result['staleness'], result['sync_substep'], result['substep'],
+                result['speedup'], result['halo_stale'], result['halo_error'], result['drift']))
+    return '\n'.join(lines)
+
+
+def scaling_table(results):
+    phases = list(results[0]['phases'])
+    lines = ['| mode | ranks | particles | wall (secs) | substep (secs) | speedup | efficiency | '
+             + ' | '.join(phases) + ' |',
+             '| --- ' * (7 + len(phases)) + '|']
+    for result in results:
+        lines.append('| {} | {} | {} | {:.3g} | {:.3g} | {:.2f} | {:.2f} | '.format(
+            result['mode'], result['ranks'], result['particles'], result['wall'], result['substep'],
+            result['speedup'], result['efficiency'])
+            + ' | '.join('{:.3g}'.format(result['phases'][phase]['max']) for phase in phases) + ' |')
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='strong/weak scaling sweep of main.py')
+    parser.add_argument('--ranks', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--modes', nargs='+', choices=('strong', 'weak', 'stale'), default=['strong', 'weak'])
+    parser.add_argument('--particles', type=int, default=4096, help='strong scaling and stale total')
+    parser.add_argument('--per-rank', type=int, default=1024, help='weak scaling particles per rank')
+    parser.add_argument('--staleness', type=int, default=2, help='--halo-staleness of the stale runs')
+    parser.add_argument('--grid', type=int, default=128)
+    parser.add_argument('--frames', type=int, default=6)
+    parser.add_argument('--substeps', type=int, default=50)
+    parser.add_argument('--skip', type=int, default=1, help='leading frames left out of the timings')
+    parser.add_argument('--decomposition', choices=('block', 'slab'), default='block')
+    parser.add_argument('--arch', default='cpu')
+    parser.add_argument('--mpiexec', default='mpiexec', help='launcher, e.g. "mpiexec --oversubscribe"')
+    parser.add_argument('--out', default='bench')
+    # anything after -- goes to main.py unchanged
+    args, extra = parser.parse_known_args()
+    args.extra = [arg for arg in extra if arg != '--']
+    args.out = os.path.abspath(args.out)
+    os.makedirs(args.out, exist_ok=True)
+
+    results = []
+    for mode in args.modes:
+        for ranks in args.ranks:
+            if mode == 'stale':
+                results.append(stale(ranks, args))
+                continue
+            particles = args.particles if mode == 'strong' else args.per_rank * ranks
+            results.append(run(mode, ranks, particles, args))
+    scaling(results)
+
+    with open(os.path.join(args.out, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    table = markdown(results)
+    with open(os.path.join(args.out, 'results.md'), 'w') as f:
+        f.write(table + '\n')
+    print(table)
@@ -1,28 +1,46 @@
-import taichi as ti
-import numpy as np
+import argparse
 import time
+
+import taichi as ti
+
+import frame_io
+
 ti.init()
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='play back the frames main.py wrote')
+    parser.add_argument('--input', default='out8', help='main.py --output-dir, or the archive')
+    parser.add_argument('--format', choices=frame_io.formats + ('archive',), default='txt',
+                        help='main.py --output-format, or archive for a pack_frames.py archive')
+    parser.add_argument('--ranks', type=int, default=None, help='rank files per frame (default: all found)')
+    parser.add_argument('--first', type=int, default=0)
+    parser.add_argument('--last', type=int, default=None, help='last frame to show (default: the last written)')
+    parser.add_argument('--fps', type=float, default=10, help='frames per second, 0 = as fast as they load')
+    parser.add_argument('--prefetch', type=int, default=4, help='frames read ahead of the one shown')
+    parser.add_argument('--workers', type=int, default=2, help='reader threads')
+    parser.add_argument('--listen', type=int, default=None,
+                        help='show the frames main.py --in-situ stream sends to this port instead')
+    args = parser.parse_args()
+
+    if args.listen is not None:
+        # frames are shown as they arrive
+        source = frame_io.receive_frames(args.listen)
+        args.fps = 0
+    else:
+        frames = [it for it in frame_io.frame_numbers(args.input, args.format)
+                  if it >= args.first and (args.last is None or it <= args.last)]
+        source = frame_io.prefetch_frames(args.input, args.format, frames,
+                                          args.prefetch, args.workers, args.ranks)
     gui = ti.GUI('My MPM88')
-    it = 0
-    filecnt = 8
-    end_it = 100
-    input_name = 'out8'
-    while gui.running and not gui.get_event(gui.ESCAPE):
-        data = None
-        for d in range(filecnt):
-            new_data = np.genfromtxt(fname='{}/{}-output-{}.txt'.format(input_name, d, it), delimiter=",")
-            new_data = new_data.reshape((-1, 2))
-            if data is None:
-                data = new_data
-            else:
-                data = np.vstack([data, new_data])
-        print(data.shape)
+    next_show = time.perf_counter()
+    for it, data, counts in source:
+        if not gui.running or gui.get_event(gui.ESCAPE):
+            break
+        print(it, data.shape)
         gui.clear(0x112F41)
         gui.circles(data, radius=2, color=0x068587)
+        # the wait is whatever is left of the frame's time slot, so a slow
+        # read or draw does not slow playback down further
+        if args.fps > 0:
+            next_show += 1 / args.fps
+            time.sleep(max(0.0, next_show - time.perf_counter()))
         gui.show()
-        it += 1
-        if it >= end_it:
-            break
-        time.sleep(0.1)
-
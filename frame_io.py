@@ -0,0 +1,421 @@
+import glob
+import mmap
+import os
+import re
+import socket
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Snapshot formats written by main.py (write_data) and read back by the
+# viewer and tools:
+#   txt    {dir}/{rank}-output-{it}.txt  comma separated x,y per line
+#   npy    {dir}/{rank}-output-{it}.npy  float32 (n, 2) per rank
+#   mpiio  {dir}/output-{it}.bin         one shared file per frame: int32
+#                                        rank count, int32 particle count
+#                                        per rank, then float32 (x, y) of
+#                                        every particle in rank order
+#   delta  {dir}/output-{it}.dlt         one file per frame, positions by
+#                                        particle id, see below
+formats = ('txt', 'npy', 'mpiio', 'delta')
+
+# Checkpoints use the mpiio layout with the frame to resume from in front
+# of the header and 10 float32 per particle: x (2), v (2), C (4, row
+# major), J and the bits of the int32 particle id. Migration moves
+# particles as the same rows.
+CHECKPOINT_WIDTH = 10
+
+# Archives (pack_frames.py) hold every frame of a run in one file:
+#   the frames back to back, each one chunk of float32 (x, y) rows. With
+#   ARCHIVE_ZLIB the chunk is zlib compressed after its bytes are shuffled
+#   into planes (every float's first byte, then every second byte, ...),
+#   which compresses positions much better.
+#   the index: int64 (frame, chunk offset, chunk bytes, particles, ranks)
+#   per frame
+#   the int32 particle count of every rank of every frame, zero padded to
+#   the most ranks any frame has
+#   a trailer of 6 int64: ARCHIVE_MAGIC, the flags, the frame count, the
+#   rank count, the offset of the index, and 0.
+# Readers map the file and only touch the trailer, the index and the chunk
+# of the frame they want.
+ARCHIVE_MAGIC = 0x31435241414D504D
+ARCHIVE_ZLIB = 1
+ARCHIVE_TRAILER = 6
+archives = {}
+
+
+# Delta frames store every particle's position in fixed point, a step of
+# quantum = 2 * error per unit, in particle id order, so no coordinate is
+# off by more than error. A keyframe holds the fixed-point positions; the
+# frames after it, up to the next keyframe, hold the difference to the
+# position predicted from the two frames before (one right after the
+# keyframe), which for particles that keep their speed is close to 0.
+# Each file is an int64 header: DELTA_MAGIC, 1 for a keyframe, the
+# particle count, the keyframe's frame, the rank count, the bytes per
+# value and the float64 bits of the quantum; then the int32 particle count
+# of each rank, and a zlib stream of the values, shuffled into byte planes
+# and as narrow as they fit.
+DELTA_MAGIC = 0x31544C44414D504D
+DELTA_HEADER = 7
+delta_encoders = {}
+delta_decoders = {}
+
+
+# main.py --in-situ stream sends every frame over TCP as an int64 header
+# (STREAM_MAGIC, frame, particle count) and the float32 (x, y) rows.
+STREAM_MAGIC = 0x31525453414D504D
+
+
+def frame_path(directory, fmt, it, rank=None):
+    if fmt == 'mpiio':
+        return '{}/output-{}.bin'.format(directory, it)
+    if fmt == 'delta':
+        return '{}/output-{}.dlt'.format(directory, it)
+    return '{}/{}-output-{}.{}'.format(directory, rank, it, fmt)
+
+
+def write_frame(comm, directory, fmt, it, data, ids=None, **options):
+    # ids, the particle ids of the rows of data, and options (error,
+    # keyframe_interval) are for 'delta'
+    if fmt == 'delta':
+        write_delta(comm, directory, it, data, ids, **options)
+    elif fmt == 'txt':
+        np.savetxt(frame_path(directory, fmt, it, comm.Get_rank()), data, delimiter=",")
+    elif fmt == 'npy':
+        np.save(frame_path(directory, fmt, it, comm.Get_rank()), data.astype(np.float32))
+    elif fmt == 'mpiio':
+        write_shared(comm, frame_path(directory, fmt, it), data)
+    else:
+        raise ValueError('unknown output format {}'.format(fmt))
+
+
+def shuffle(values):
+    # bytes of every value's first byte, then every second byte, ...
+    return np.ascontiguousarray(values).view(np.uint8).reshape((-1, values.itemsize)).T.tobytes()
+
+
+def unshuffle(raw, dtype):
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(raw, dtype=np.uint8).reshape((dtype.itemsize, -1))
+    return np.ascontiguousarray(planes.T).view(dtype).ravel()
+
+
+def narrowest(values):
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if values.size == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return values.astype(dtype)
+    return values
+
+
+def write_delta(comm, directory, it, data, ids, error=1e-5, keyframe_interval=10, level=6):
+    # gathered to rank 0, which keeps the two frames before in
+    # delta_encoders to predict from, along with the bytes written, the
+    # bytes float32 positions would take and the largest error so far
+    counts = comm.gather(data.shape[0], root=0)
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    ids = np.ascontiguousarray(ids, dtype=np.int32)
+    if comm.Get_rank() == 0:
+        total = sum(counts)
+        all_data = np.empty((total, 2), dtype=np.float32)
+        all_ids = np.empty(total, dtype=np.int32)
+    else:
+        all_data, all_ids = None, None
+    comm.Gatherv(data, [all_data, [2 * count for count in counts]] if all_data is not None else None, root=0)
+    comm.Gatherv(ids, [all_ids, counts] if all_ids is not None else None, root=0)
+    if comm.Get_rank() != 0:
+        return
+
+    quantum = 2 * error
+    positions = np.empty((all_ids.max() + 1 if all_ids.size else 0, 2), dtype=np.float64)
+    positions[all_ids] = all_data
+    q = np.rint(positions / quantum).astype(np.int64)
+    encoder = delta_encoders.setdefault(directory, {'raw': 0, 'stored': 0, 'max_error': 0.0, 'frames': 0,
+                                                    'history': [], 'last': None, 'key': None})
+    history = encoder['history']
+    key = (encoder['last'] != it - 1 or it - encoder['key'] >= keyframe_interval
+           or history[-1].shape != q.shape or history[-1].size == 0)
+    if key:
+        encoder['key'], history[:] = it, []
+        values = q
+    elif len(history) == 1:
+        values = q - history[-1]
+    else:
+        values = q - (2 * history[-1] - history[-2])
+    values = narrowest(values)
+    header = np.array([DELTA_MAGIC, int(key), q.shape[0], encoder['key'], len(counts), values.itemsize, 0],
+                      dtype=np.int64)
+    header[6:] = np.array([quantum], dtype=np.float64).view(np.int64)
+    path = frame_path(directory, 'delta', it)
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(np.array(counts, dtype=np.int32).tobytes())
+        f.write(zlib.compress(shuffle(values), level))
+    history[:] = history[-1:] + [q]
+    encoder['last'] = it
+    encoder['frames'] += 1
+    encoder['raw'] += all_data.nbytes
+    encoder['stored'] += os.path.getsize(path)
+    if all_data.size:
+        encoder['max_error'] = max(encoder['max_error'], float(np.abs(q[all_ids] * quantum - all_data).max()))
+
+
+def read_delta_file(path):
+    with open(path, 'rb') as f:
+        header = np.fromfile(f, dtype=np.int64, count=DELTA_HEADER)
+        if header.size < DELTA_HEADER or header[0] != DELTA_MAGIC:
+            raise ValueError('{} is not a delta frame'.format(path))
+        counts = np.fromfile(f, dtype=np.int32, count=int(header[4]))
+        values = unshuffle(zlib.decompress(f.read()), 'i{}'.format(int(header[5]))).astype(np.int64)
+    quantum = float(header[6:].view(np.float64)[0])
+    return bool(header[1]), int(header[3]), quantum, counts, values.reshape((-1, 2))
+
+
+def read_delta(directory, it, out=None):
+    # decodes forward from the keyframe, or from the frame before when the
+    # last read of directory was that one, as in playback
+    key, key_it, quantum, counts, values = read_delta_file(frame_path(directory, 'delta', it))
+    state = delta_decoders.get(directory)
+    if key:
+        history = [values]
+    elif state is not None and state['it'] == it - 1 and state['key'] == key_it:
+        history = state['history']
+        predicted = history[-1] if len(history) == 1 else 2 * history[-1] - history[-2]
+        history = history[-1:] + [predicted + values]
+    else:
+        history = [read_delta_file(frame_path(directory, 'delta', key_it))[4]]
+        for step in range(key_it + 1, it + 1):
+            step_values = values if step == it else read_delta_file(frame_path(directory, 'delta', step))[4]
+            predicted = history[-1] if len(history) == 1 else 2 * history[-1] - history[-2]
+            history = history[-1:] + [predicted + step_values]
+    delta_decoders[directory] = {'it': it, 'key': key_it, 'history': history}
+    total = history[-1].shape[0]
+    if out is None or out.shape[0] < total:
+        out = np.empty((total, 2), dtype=np.float32)
+    out[:total] = history[-1] * quantum
+    return out[:total], counts
+
+
+def write_shared(comm, path, data, prefix=()):
+    # imported here so the readers work without an MPI runtime
+    from mpi4py import MPI
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    rank, size = comm.Get_rank(), comm.Get_size()
+    counts = comm.gather(data.shape[0], root=0)
+    start = comm.exscan(data.shape[0]) or 0
+    header_bytes = 4 * (len(prefix) + 1 + size)
+    row_bytes = data.itemsize * data.shape[1]
+
+    f = MPI.File.Open(comm, path, MPI.MODE_WRONLY | MPI.MODE_CREATE)
+    f.Set_size(0)
+    if rank == 0:
+        f.Write_at(0, np.array(list(prefix) + [size] + counts, dtype=np.int32))
+    f.Write_at_all(header_bytes + start * row_bytes, data)
+    f.Close()
+
+
+def read_shared(path, out=None):
+    with open(path, 'rb') as f:
+        size = int(np.fromfile(f, dtype=np.int32, count=1)[0])
+        counts = np.fromfile(f, dtype=np.int32, count=size)
+        total = int(counts.sum())
+        if out is None or out.shape[0] < total:
+            out = np.empty((total, 2), dtype=np.float32)
+        f.readinto(memoryview(out[:total]).cast('B'))
+    return out[:total], counts
+
+
+def read_text(path):
+    # np.fromstring's whitespace separator also splits lines; much faster
+    # than loadtxt / genfromtxt for the plain x,y rows write_frame makes
+    with open(path) as f:
+        text = f.read().replace(',', ' ')
+    return np.fromstring(text, dtype=np.float32, sep=' ').reshape((-1, 2))
+
+
+def frame_numbers(directory, fmt):
+    # the frames written to directory, in order
+    if fmt == 'archive':
+        return [int(it) for it in open_archive(directory)['index'][:, 0]]
+    if fmt in ('mpiio', 'delta'):
+        pattern = os.path.basename(frame_path('', fmt, '*'))
+    else:
+        pattern = '0-output-*.{}'.format(fmt)
+    found = (re.search(r'output-(\d+)\.', os.path.basename(path))
+             for path in glob.glob(os.path.join(directory, pattern)))
+    return sorted(int(match.group(1)) for match in found if match)
+
+
+def read_frame(directory, fmt, it, n_ranks=None, out=None):
+    # returns the (n, 2) positions of frame it and the particle count of
+    # every rank that wrote it; for an 'archive' directory is the archive
+    # file. Given out, a float32 (capacity, 2) array,
+    # the positions are assembled in its first n rows (it is replaced by a
+    # bigger one if they do not fit) and out[:n] is returned.
+    if fmt == 'mpiio':
+        return read_shared(frame_path(directory, fmt, it), out)
+    if fmt == 'archive':
+        return read_archive(directory, it, out)
+    if fmt == 'delta':
+        return read_delta(directory, it, out)
+    if n_ranks is None:
+        n_ranks = len(glob.glob(os.path.join(directory, '*-output-{}.{}'.format(it, fmt))))
+    paths = [frame_path(directory, fmt, it, rank) for rank in range(n_ranks)]
+    if fmt == 'npy':
+        # only the headers are read until the rows are copied into place
+        parts = [np.load(path, mmap_mode='r') for path in paths]
+    else:
+        parts = [read_text(path) for path in paths]
+    counts = np.array([part.shape[0] for part in parts], dtype=np.int32)
+    total = int(counts.sum())
+    if out is None or out.shape[0] < total:
+        out = np.empty((total, 2), dtype=np.float32)
+    start = 0
+    for part in parts:
+        out[start:start + part.shape[0]] = part
+        start += part.shape[0]
+    return out[:total], counts
+
+
+def prefetch_frames(directory, fmt, frames, ahead=4, workers=2, n_ranks=None):
+    # yields (it, positions, counts) for every it in frames while a thread
+    # pool reads the next ahead frames. Each frame is assembled into one of
+    # ahead + 1 reused buffers, so the positions of a frame are only valid
+    # until the generator is resumed.
+    frames = list(frames)
+    buffers = [None] * (ahead + 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit(k):
+            slot = k % len(buffers)
+            return pool.submit(read_frame, directory, fmt, frames[k], n_ranks, buffers[slot])
+
+        pending = [submit(k) for k in range(min(ahead, len(frames)))]
+        for k, it in enumerate(frames):
+            data, counts = pending.pop(0).result()
+            # keep a buffer the read had to grow
+            buffers[k % len(buffers)] = data.base if data.base is not None else data
+            if k + ahead < len(frames):
+                pending.append(submit(k + ahead))
+            yield it, data, counts
+
+
+def send_frame(connection, it, data):
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    connection.sendall(np.array([STREAM_MAGIC, it, data.shape[0]], dtype=np.int64).tobytes())
+    connection.sendall(data.tobytes())
+
+
+def receive_exactly(connection, size):
+    buf = bytearray(size)
+    view, got = memoryview(buf), 0
+    while got < size:
+        n = connection.recv_into(view[got:])
+        if n == 0:
+            return None
+        got += n
+    return buf
+
+
+def receive_frames(port, host=''):
+    # waits for one main.py --in-situ stream on port and yields
+    # (it, positions, counts) like prefetch_frames until the run ends
+    with socket.create_server((host, port)) as server:
+        connection, _ = server.accept()
+    with connection:
+        while True:
+            header = receive_exactly(connection, 24)
+            if header is None:
+                return
+            magic, it, total = np.frombuffer(header, dtype=np.int64)
+            if magic != STREAM_MAGIC:
+                raise ValueError('not an in-situ frame stream')
+            payload = receive_exactly(connection, 8 * int(total))
+            if payload is None:
+                return
+            yield int(it), np.frombuffer(payload, dtype=np.float32).reshape((-1, 2)), \
+                np.array([total], dtype=np.int32)
+
+
+def write_archive(path, frames, level=6):
+    # frames yields (it, positions, counts) in frame order, as
+    # prefetch_frames does; level 0 stores the chunks uncompressed
+    flags = ARCHIVE_ZLIB if level > 0 else 0
+    index, rank_counts = [], []
+    with open(path + '.tmp', 'wb') as f:
+        for it, data, counts in frames:
+            chunk = np.ascontiguousarray(data, dtype=np.float32)
+            chunk = zlib.compress(shuffle(chunk), level) if flags & ARCHIVE_ZLIB else chunk.tobytes()
+            index.append((it, f.tell(), len(chunk), data.shape[0], len(counts)))
+            rank_counts.append(counts)
+            f.write(chunk)
+        n_ranks = max((len(counts) for counts in rank_counts), default=0)
+        table = np.zeros((len(rank_counts), n_ranks), dtype=np.int32)
+        for k, counts in enumerate(rank_counts):
+            table[k, :len(counts)] = counts
+        index_offset = f.tell()
+        f.write(np.array(index, dtype=np.int64).reshape((-1, 5)).tobytes())
+        f.write(table.tobytes())
+        f.write(np.array([ARCHIVE_MAGIC, flags, len(index), n_ranks, index_offset, 0], dtype=np.int64).tobytes())
+    os.replace(path + '.tmp', path)
+
+
+def open_archive(path):
+    # the mapped file, its flags, index and per-rank counts; kept open and
+    # shared by every later read of the same path
+    if path not in archives:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        trailer = np.frombuffer(data, dtype=np.int64, count=ARCHIVE_TRAILER,
+                                offset=len(data) - 8 * ARCHIVE_TRAILER)
+        magic, flags, n_frames, n_ranks, index_offset, _ = (int(value) for value in trailer)
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError('{} is not a frame archive'.format(path))
+        index = np.frombuffer(data, dtype=np.int64, count=5 * n_frames, offset=index_offset).reshape((-1, 5))
+        counts = np.frombuffer(data, dtype=np.int32, count=n_frames * n_ranks,
+                               offset=index_offset + index.nbytes).reshape((n_frames, n_ranks))
+        archives[path] = {'data': data, 'flags': flags, 'index': index, 'counts': counts}
+    return archives[path]
+
+
+def read_archive(path, it, out=None):
+    archive = open_archive(path)
+    index = archive['index']
+    # frames are stored in order, usually without gaps
+    k = it - int(index[0, 0]) if len(index) else 0
+    if not 0 <= k < len(index) or index[k, 0] != it:
+        k = int(np.searchsorted(index[:, 0], it))
+        if k == len(index) or index[k, 0] != it:
+            raise KeyError('frame {} is not in {}'.format(it, path))
+    _, offset, size, total, n_ranks = (int(value) for value in index[k])
+    if out is None or out.shape[0] < total:
+        out = np.empty((total, 2), dtype=np.float32)
+    chunk = archive['data'][offset:offset + size]
+    if archive['flags'] & ARCHIVE_ZLIB:
+        out[:total] = unshuffle(zlib.decompress(chunk), np.float32).reshape((-1, 2))
+    else:
+        out[:total] = np.frombuffer(chunk, dtype=np.float32).reshape((-1, 2))
+    return out[:total], archive['counts'][k, :n_ranks]
+
+
+def write_checkpoint(comm, path, frame, records):
+    # written next to path and renamed once complete, so a job killed
+    # mid-write leaves the previous checkpoint intact
+    write_shared(comm, path + '.tmp', records, prefix=(frame,))
+    comm.Barrier()
+    if comm.Get_rank() == 0:
+        os.replace(path + '.tmp', path)
+    comm.Barrier()
+
+
+def read_checkpoint(path, part, n_parts):
+    # the frame to resume from and the part-th of n_parts equal slices of
+    # the saved particles, whatever rank count wrote them
+    with open(path, 'rb') as f:
+        frame, size = np.fromfile(f, dtype=np.int32, count=2)
+        counts = np.fromfile(f, dtype=np.int32, count=size)
+        total = int(counts.sum())
+        start, stop = part * total // n_parts, (part + 1) * total // n_parts
+        f.seek(4 * (2 + size) + 4 * CHECKPOINT_WIDTH * start)
+        records = np.fromfile(f, dtype=np.float32, count=CHECKPOINT_WIDTH * (stop - start))
+    return int(frame), records.reshape((-1, CHECKPOINT_WIDTH))
@@ -1,23 +1,91 @@
 import taichi as ti
 from mpi4py import MPI
 import numpy as np
-import hashlib
+import argparse
+import json
+import os
+import queue
+import socket
+import threading
 import time
-ti.init(arch=ti.gpu)
-
-n_nodes = 4
+import frame_io
+import render_frames
+import wire
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
-n_particles = 4096
+parser = argparse.ArgumentParser(description='MLS-MPM water split over MPI ranks')
+parser.add_argument('--arch', default='gpu', help='taichi backend (gpu, cpu, cuda, vulkan, ...)')
+parser.add_argument('--nodes', type=int, default=comm.Get_size(), help='ranks, must match mpiexec -n')
+parser.add_argument('--particles', type=int, default=4096, help='particles over all ranks')
+parser.add_argument('--grid', type=int, default=128, help='grid cells per side')
+parser.add_argument('--frames', type=int, default=100)
+parser.add_argument('--substeps', type=int, default=50, help='substeps per frame')
+parser.add_argument('--decomposition', choices=('block', 'slab'), default='block')
+parser.add_argument('--rebalance-interval', type=int, default=500, help='substeps, 0 = never')
+parser.add_argument('--rebalance-by', choices=('count', 'time'), default='count')
+parser.add_argument('--skin', type=int, default=0, help='cells particles may drift before migrating')
+parser.add_argument('--pipelined-migration', action='store_true',
+                    help='overlap migration messages with the next substep\'s P2G')
+parser.add_argument('--no-shared-halo', action='store_true',
+                    help='send halos to neighbours on the same node as messages too')
+parser.add_argument('--halo-staleness', type=int, default=0,
+                    help='substeps a rank may run ahead of its neighbours\' halos, 0 = lockstep')
+parser.add_argument('--halo-error', choices=('max', 'rms', 'relative'), default='rms',
+                    help='how late halos are compared to the estimate used in their place')
+parser.add_argument('--wire', choices=('raw', 'compact'), default='raw',
+                    help='compact: sparse halos and packed particles behind a header (wire.py)')
+parser.add_argument('--wire-float16', action='store_true',
+                    help='with --wire compact, send halo velocities and particle v, C as float16')
+parser.add_argument('--particle-layout', choices=('soa', 'aos'), default='soa',
+                    help='x, v, C, J in separate arrays, or interleaved per particle')
+parser.add_argument('--grid-layout', choices=('dense', 'pointer', 'bitmasked'), default='dense')
+parser.add_argument('--grid-block', type=int, default=8, help='cells per side of a sparse grid block')
+parser.add_argument('--sort-interval', type=int, default=0, help='substeps between particle sorts, 0 = never')
+parser.add_argument('--sort-by', choices=('cell', 'block'), default='cell')
+parser.add_argument('--output-dir', default='out4')
+parser.add_argument('--output-format', choices=frame_io.formats + ('none',), default='txt')
+parser.add_argument('--delta-error', type=float, default=1e-5,
+                    help='largest position error of --output-format delta, domain units')
+parser.add_argument('--keyframe-interval', type=int, default=10, help='frames per delta keyframe')
+parser.add_argument('--sync-output', action='store_true', help='write frames on the solver thread')
+parser.add_argument('--in-situ', choices=('none', 'png', 'stream'), default='none',
+                    help='gather every frame to rank 0 and render it (png) or send it to a viewer (stream)')
+parser.add_argument('--in-situ-target', default='insitu',
+                    help='png: directory for the images; stream: host:port of check_read.py --listen')
+parser.add_argument('--in-situ-stride', type=int, default=1,
+                    help='gather only particles whose id is a multiple of this')
+parser.add_argument('--in-situ-size', type=int, default=512, help='png width and height in pixels')
+parser.add_argument('--checkpoint-interval', type=int, default=10, help='frames, 0 = never')
+parser.add_argument('--checkpoint-path', default='checkpoint.bin')
+parser.add_argument('--restart', action='store_true', help='resume from --checkpoint-path')
+parser.add_argument('--profile-path', default='profile.jsonl')
+parser.add_argument('--no-profile-sync', action='store_true',
+                    help='do not wait for the device between phases (faster, coarser timing)')
+# unknown arguments are only an error when run as a script, so the module
+# can still be imported from other tools
+args, unknown_args = parser.parse_known_args()
+
+# a seed per rank, so no two ranks draw the same random numbers
+ti.init(arch=getattr(ti, args.arch), random_seed=rank)
+
+n_nodes = args.nodes
+if n_nodes != comm.Get_size():
+    parser.error('--nodes {} but {} MPI ranks are running'.format(n_nodes, comm.Get_size()))
+
+n_particles = args.particles
 
 cur_particle_num = n_particles // n_nodes
 
+n_frames = args.frames
+frame_substeps = args.substeps
 
-n_grid = 128
+n_grid = args.grid
 dx = 1 / n_grid
-dt = 2e-4
+# 2e-4 at the original 128 cells; the time step shrinks with the cell size
+# to stay stable at higher resolutions
+dt = 2e-4 * 128 / n_grid
 
 p_rho = 1
 p_vol = (dx * 0.5)**2
@@ -26,61 +94,307 @@ gravity = 9.8
 bound = 3
 E = 400
 
-x = ti.Vector.field(2, float, n_particles)
-v = ti.Vector.field(2, float, n_particles)
-C = ti.Matrix.field(2, 2, float, n_particles)
-J = ti.field(float, n_particles)
+# particle slots per rank; grows (see grow_particles) when migration
+# brings in more particles than fit. 'soa' keeps x, v, C, J and pid in
+# an array each, 'aos' one record of all five per particle, like the rows
+# migration and checkpoints pack them into.
+particle_capacity = 2 * cur_particle_num
+particle_layout = args.particle_layout
+
+
+def allocate_particles(capacity):
+    # a separate SNode tree per allocation so the old one can be freed on
+    # growth; kernels take the fields as templates because they bind the
+    # fields they were compiled with
+    builder = ti.FieldsBuilder()
+    fields = (ti.Vector.field(2, float), ti.Vector.field(2, float),
+              ti.Matrix.field(2, 2, float), ti.field(float), ti.field(ti.i32))
+    if particle_layout == 'aos':
+        builder.dense(ti.i, capacity).place(*fields)
+    else:
+        for field in fields:
+            builder.dense(ti.i, capacity).place(field)
+    return fields + (builder.finalize(),)
+
+
+# pid is a particle's number over all ranks, kept through migration and
+# sorting so frames can be matched up particle by particle
+x, v, C, J, pid, particle_tree = allocate_particles(particle_capacity)
+
+# 'dense' allocates, clears and updates every cell each substep; 'pointer'
+# and 'bitmasked' split the grid into grid_block x grid_block blocks that
+# P2G activates where particles land, so clearing and g_cal only cost the
+# occupied part of the domain ('pointer' also only allocates those blocks)
+grid_layout = args.grid_layout
+grid_block = args.grid_block
+
+
+def allocate_grid(shape):
+    # a rank only holds the cells of its block and ghost cells (see
+    # fit_grid), in a tree of its own that is freed when a rebalance needs
+    # a bigger one; like the particles, kernels take it as templates
+    grid_v = ti.Vector.field(2, float)
+    grid_m = ti.field(float)
+    builder = ti.FieldsBuilder()
+    if grid_layout == 'dense':
+        builder.dense(ti.ij, shape).place(grid_v)
+        builder.dense(ti.ij, shape).place(grid_m)
+    else:
+        blocks = [(n + grid_block - 1) // grid_block for n in shape]
+        getattr(builder, grid_layout)(ti.ij, blocks).dense(ti.ij, grid_block).place(grid_v, grid_m)
+    return grid_v, grid_m, builder.finalize()
+
+
+# global index of the local grid's cell [0, 0]
+grid_origin = ti.Vector.field(2, int, ())
+grid_shape = (0, 0)
+grid_v, grid_m, grid_tree = None, None, None
+
+# ranks form a proc_dims[0] x proc_dims[1] Cartesian grid of blocks; the
+# rank at (cx, cy) owns columns [x_bounds[cx], x_bounds[cx+1]) and rows
+# [y_bounds[cy], y_bounds[cy+1]). 'slab' keeps one row of vertical slabs.
+decomposition = args.decomposition
+proc_dims = MPI.Compute_dims(n_nodes, 2) if decomposition == 'block' else [n_nodes, 1]
+cart = comm.Create_cart(proc_dims, periods=[False, False], reorder=False)
+cx, cy = cart.Get_coords(rank)
+
+# the bounds start uniform and move every rebalance_interval substeps
+# (0 = never) so each rank carries about the same particle count ('count')
+# or P2G/G2P time ('time')
+x_bounds = [i * n_grid // proc_dims[0] for i in range(proc_dims[0] + 1)]
+y_bounds = [j * n_grid // proc_dims[1] for j in range(proc_dims[1] + 1)]
+rebalance_interval = args.rebalance_interval
+rebalance_by = args.rebalance_by
+particle_time = 0.0
+
+# wall time per phase on this rank, accumulated between frames and reduced
+# to min/mean/max across ranks at every frame boundary (see report_phases);
+# profile_sync waits for the device so asynchronous kernels are charged to
+# their own phase. g_cal_inner is the part of g_cal that runs while the x
+# halo is in flight, i.e. the communication it hides.
+phases = ('rebalance', 'sort', 'p2g', 'g_cal_inner', 'sync_grid', 'g_cal', 'g2p', 'transfer')
+phase_time = dict.fromkeys(phases, 0.0)
+profile_path = args.profile_path
+profile_sync = not args.no_profile_sync
+
+# snapshot every frame as 'txt', 'npy' (binary, one file per rank), 'mpiio'
+# (binary, one shared file per frame), 'delta' (fixed point, by particle
+# id, relative to the frames before; see frame_io) or 'none'
+output_dir = args.output_dir
+output_format = args.output_format
+output_options = {'error': args.delta_error, 'keyframe_interval': args.keyframe_interval} \
+    if output_format == 'delta' else {}
+
+# frames go to a background writer through two host buffers, so the solver
+# only waits on the disk when both are still queued or being written;
+# async_output = False (or an MPI without THREAD_MULTIPLE) writes inline
+async_output = not args.sync_output
+free_buffers = queue.Queue()
+frame_queue = queue.Queue()
+writer_thread = None
+writer_error = None
+
+# in-situ view: at every frame boundary the ranks Igatherv the positions
+# of every in_situ_stride-th particle (by pid) to rank 0, on a
+# communicator of their own, and carry on. The gather is completed at the
+# next frame boundary, and rank 0 hands the frame to a thread that renders
+# it to a PNG ('png') or sends it to a check_read.py --listen viewer
+# ('stream'). No rank touches the frame files for this. A view that falls
+# behind drops frames and one that fails stops, but the run carries on.
+in_situ = args.in_situ
+in_situ_target = args.in_situ_target
+in_situ_address = None
+if in_situ == 'stream':
+    host, _, port = in_situ_target.rpartition(':')
+    if not host or not port.isdigit():
+        parser.error('--in-situ stream needs --in-situ-target host:port, not {}'.format(in_situ_target))
+    in_situ_address = (host, int(port))
+in_situ_stride = args.in_situ_stride
+in_situ_size = args.in_situ_size
+view_comm = comm.Dup() if in_situ != 'none' else None
+view_pending = None
+view_queue = queue.Queue(maxsize=2)
+view_thread = None
+view_error = None
+view_dropped = 0
+
+# every checkpoint_interval frames (0 = never) the particles and the frame
+# to resume from are saved to checkpoint_path; with restart = True the run
+# picks up from there, on any number of ranks
+checkpoint_interval = args.checkpoint_interval
+checkpoint_path = args.checkpoint_path
+restart = args.restart
+
+# particles may drift up to skin cells outside their block before they
+# migrate; migration then only runs every few substeps, as often as the
+# fastest particle needs to stay inside the skin (skin = 0 migrates every
+# substep). skin_safety leaves room for particles to speed up in between.
+skin = args.skin
+skin_safety = 0.5
+max_migration_interval = 50
+next_migration = 0
+
+# With pipelined_migration, a migration after G2P only packs the leaving
+# particles and starts the size exchange. The next substep sends the
+# records, runs P2G over the particles that stayed while they are in
+# flight, and then splats the arrivals on top with p2g_arrivals. Sorting,
+# rebalancing and the end of a frame finish a pending migration first.
+pipelined_migration = args.pipelined_migration
+pending_transfer = None
+
+# ghost cells on each side of a block; P2G of a particle in the block
+# reaches at most 1 cell below and 2 cells above its own cell, plus the skin
+halo = 2 + skin
+assert n_grid // max(proc_dims) >= 2 * halo, 'block narrower than its halo'
+TAG_GRID = 0
+
+# ranks of the (up to) 8 surrounding blocks, keyed by (dx, dy) offset
+neighbours = {}
+for ox in (-1, 0, 1):
+    for oy in (-1, 0, 1):
+        if (ox, oy) != (0, 0) and 0 <= cx + ox < proc_dims[0] and 0 <= cy + oy < proc_dims[1]:
+            neighbours[ox, oy] = cart.Get_cart_rank([cx + ox, cy + oy])
+
+# neighbours on the same node swap halos through a shared-memory window
+# instead of messages: every rank packs its strips into its own slots of
+# the window and the neighbour adds them straight from there, once a
+# barrier over the node's ranks says they are written. There is a slot per
+# axis and side, so a strip is only rewritten after the other axis'
+# barrier, by which time every reader is done with it.
+shared_halo = not args.no_shared_halo
+node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+node_rank = node_comm.Get_rank()
+if node_comm.Get_size() == 1 or args.halo_staleness > 0:
+    shared_halo = False
+shared_neighbours = {}
+if shared_halo:
+    node_of = dict(zip(node_comm.allgather(rank), range(node_comm.Get_size())))
+    shared_neighbours = {offset: node_of[r] for offset, r in neighbours.items() if r in node_of}
+    slot_size = 2 * halo * n_grid * 3
+    halo_win = MPI.Win.Allocate_shared(2 * 2 * slot_size * 4, 4, comm=node_comm)
+    halo_win.Lock_all(MPI.MODE_NOCHECK)
+    halo_slots = [np.ndarray((2, 2, slot_size), dtype=np.float32, buffer=halo_win.Shared_query(r)[0])
+                  for r in range(node_comm.Get_size())]
+
+# With halo_staleness = S > 0 the halo strips are streamed instead: every
+# substep each rank sends its strips and carries on with the neighbour's
+# newest one, waiting only when that is more than S substeps old. When
+# the real strip of a substep that ran on an estimate turns up, it is
+# compared with the estimate (halo_error picks the metric) and becomes the
+# estimate from then on. The difference is not added back to the grid:
+# P2G rebuilds the grid momentum from the particles every substep, so
+# that would count it twice. Particle migration is still collective, so
+# with skin = 0 ranks cannot drift apart by more than a substep.
+halo_staleness = args.halo_staleness
+halo_error = args.halo_error
+TAG_GRID_ASYNC = 1  # + axis
+halo_channels = {}
+halo_sends = []
+halo_stats = {'halo_stale': 0.0, 'halo_error': 0.0}
+
+# bytes of halo and particle messages sent, and what they take as plain
+# float32 arrays; strips swapped through the shared window do not count
+wire_format = args.wire
+wire_half = args.wire_float16
+wire_stats = {'halo_bytes': 0.0, 'halo_raw': 0.0, 'particle_bytes': 0.0, 'particle_raw': 0.0}
+
+
+column_load = ti.field(int, n_grid)
+row_load = ti.field(int, n_grid)
+
+# particles leaving for each rank; this rank's slot counts the ones that
+# remain
+send_count = ti.field(int, n_nodes)
+compact_count = ti.field(int, 2)
+speed_max = ti.field(float, ())
+
+# every sort_interval substeps (0 = never) the live particles are counting
+# sorted by the grid cell, or grid_block x grid_block block, they sit in,
+# so P2G and G2P walk the grid in order instead of at random. The sorted
+# copy goes to a second set of particle fields, which then swaps with x, v,
+# C and J.
+sort_interval = args.sort_interval
+sort_by = args.sort_by
+sort_width = n_grid if sort_by == 'cell' else (n_grid + grid_block - 1) // grid_block
+sort_count = ti.field(int, sort_width * sort_width)
+sort_buffers = None
+
+@ti.func
+def scatter(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+            grid_v: ti.template(), grid_m: ti.template(), p):
+    Xp = x[p] / dx
+    base = int(Xp - 0.5)
+    fx = Xp - base
+    w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
+    stress = -dt * 4 * E * p_vol * (J[p] - 1) / dx ** 2
+    affine = ti.Matrix([[stress, 0], [0, stress]]) + p_mass * C[p]
+    for i, j in ti.static(ti.ndrange(3, 3)):
+        offset = ti.Vector([i, j])
+        dpos = (offset - fx) * dx
+        weight = w[i].x * w[j].y
+
+        grid_v[base - grid_origin[None] + offset] += weight * (p_mass * v[p] + affine @ dpos)
+        grid_m[base - grid_origin[None] + offset] += weight * p_mass
 
-grid_v = ti.Vector.field(2, float, (n_grid, n_grid))
-grid_m = ti.field(float, (n_grid, n_grid))
 
 @ti.kernel
-def p2g(particle_count: int):
+def p2g(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+        grid_v: ti.template(), grid_m: ti.template(), particle_count: int):
 
     for i, j in grid_m:
         grid_v[i, j] = [0, 0]
         grid_m[i, j] = 0
+    if ti.static(grid_layout != 'dense'):
+        # cleared first: bitmasked blocks keep their values when deactivated
+        for I in ti.grouped(grid_m.parent(2)):
+            ti.deactivate(grid_m.parent(2), I)
+
+    for p in range(particle_count):
+        scatter(x, v, C, J, grid_v, grid_m, p)
 
-    for p in range(n_particles):
-        if p >= particle_count:
-           continue
-        Xp = x[p] / dx
-        base = int(Xp - 0.5)
-        fx = Xp - base
-        w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
-        stress = -dt * 4 * E * p_vol * (J[p] - 1) / dx ** 2
-        affine = ti.Matrix([[stress, 0], [0, stress]]) + p_mass * C[p]
-        for i, j in ti.static(ti.ndrange(3, 3)):
-            offset = ti.Vector([i, j])
-            dpos = (offset - fx) * dx
-            weight = w[i].x * w[j].y
 
-            grid_v[base + offset] += weight * (p_mass * v[p] + affine @ dpos)
-            grid_m[base + offset] += weight * p_mass
+@ti.kernel
+def p2g_arrivals(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+                 grid_v: ti.template(), grid_m: ti.template(), start: int, end: int):
+    # adds particles appended after p2g ran, on top of the grid it left
+    for p in range(start, end):
+        scatter(x, v, C, J, grid_v, grid_m, p)
+
+
+@ti.func
+def update_cell(grid_v: ti.template(), grid_m: ti.template(), i, j):
+    # i, j are global, the local cell is I
+    I = ti.Vector([i, j]) - grid_origin[None]
+    if grid_m[I] > 0:
+        grid_v[I] /= grid_m[I]
+    grid_v[I].y -= dt * gravity
+    if i < bound and grid_v[I].x < 0:
+        grid_v[I].x = 0
+    if i > n_grid - bound and grid_v[I].x > 0:
+        grid_v[I].x = 0
+    if j < bound and grid_v[I].y < 0:
+        grid_v[I].y = 0
+    if j > n_grid - bound and grid_v[I].y > 0:
+        grid_v[I].y = 0
 
 
 @ti.kernel
-def g_cal():
-    x_offset = rank * n_grid // n_nodes
-    for p, q in grid_m:
-        if not (x_offset-2) <= p < ((rank+1) * n_grid // n_nodes+2):
-            continue
-        i, j = p, q
-        if grid_m[i, j] > 0:
-            grid_v[i, j] /= grid_m[i, j]
-        grid_v[i, j].y -= dt * gravity
-        if i < bound and grid_v[i, j].x < 0:
-            grid_v[i, j].x = 0
-        if i > n_grid - bound and grid_v[i, j].x > 0:
-            grid_v[i, j].x = 0
-        if j < bound and grid_v[i, j].y < 0:
-            grid_v[i, j].y = 0
-        if j > n_grid - bound and grid_v[i, j].y > 0:
-            grid_v[i, j].y = 0
+def g_cal(grid_v: ti.template(), grid_m: ti.template(),
+          col_begin: int, col_end: int, row_begin: int, row_end: int):
+    if ti.static(grid_layout == 'dense'):
+        for i, j in ti.ndrange((col_begin, col_end), (row_begin, row_end)):
+            update_cell(grid_v, grid_m, i, j)
+    else:
+        # only the active blocks are visited
+        for k, l in grid_m:
+            i, j = k + grid_origin[None].x, l + grid_origin[None].y
+            if col_begin <= i < col_end and row_begin <= j < row_end:
+                update_cell(grid_v, grid_m, i, j)
 
 
 @ti.kernel
-def g2p(particle_count: int):
+def g2p(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+        grid_v: ti.template(), particle_count: int):
 
     for p in range(particle_count):
         Xp = x[p] / dx
@@ -94,7 +408,7 @@ def g2p(particle_count: int):
             dpos = (offset - fx) * dx
             weight = w[i].x * w[j].y
 
-            g_v = grid_v[base + offset]
+            g_v = grid_v[base - grid_origin[None] + offset]
             new_v += weight * g_v
             new_C += 4 * weight * g_v.outer_product(dpos) / dx**2
         v[p] = new_v
@@ -102,164 +416,644 @@ def g2p(particle_count: int):
         J[p] *= 1 + dt * new_C.trace()
         C[p] = new_C
 
-def sync_grid(it):
-    TAG = ("{}-{}".format(it, 0))
-    TAG = int(hashlib.sha1(TAG.encode("utf-8")).hexdigest(), 16) % 1000009
-    grid_start = rank * n_grid // n_nodes
-    grid_end = (rank+1) * n_grid // n_nodes
-
-    if rank > 0:
-        m_value = {}
-        v_value = {}
-        for x_start in range(grid_start-2, grid_start):
-            if x_start < 0:
-                continue
-            for j in range(n_grid):
-                m_value[x_start, j] = grid_m[x_start, j]
-                v_value[x_start, j] = [grid_v[x_start, j].x, grid_v[x_start, j].y]
-        send_data = {"m": m_value, "v": v_value}
-        comm.send(send_data, dest=rank - 1, tag=TAG)
-    if rank < n_nodes - 1:
-        m_value = {}
-        v_value = {}
-        for x_start in range(grid_end, grid_end+2):
-            if x_start >= n_grid:
-                continue
-            for j in range(n_grid):
-                m_value[x_start, j] = grid_m[x_start, j]
-                v_value[x_start, j] = [grid_v[x_start, j].x, grid_v[x_start, j].y]
-        send_data = {"m": m_value, "v": v_value}
-        comm.send(send_data, dest=rank + 1, tag=TAG)
-    req_left = None
-    req_right = None
-    left, right = {'m': {}, 'v': {}}, {'m': {}, 'v': {}}
-    if rank > 0:
-        req_left = comm.irecv(source=rank-1, tag=TAG)
-    if rank < n_nodes - 1:
-        req_right = comm.irecv(source=rank+1, tag=TAG)
-    if req_left:
-        # print(rank, 'wait left', flush=True)
-        left = req_left.wait()
-    if req_right:
-        # print(rank, 'wait right', flush=True)
-        right = req_right.wait()
-    recv_data = {
-        'm': {**left['m'], **right['m']},
-        'v': {**left['v'], **right['v']}
-    }
-    for key in recv_data['m']:
-        i, j = key
-        grid_m[i, j] += recv_data['m'][key]
-    for key in recv_data['v']:
-        i, j = key
-        other_v = recv_data['v'][key]
-        grid_v[i, j].x += other_v[0]
-        grid_v[i, j].y += other_v[1]
+@ti.kernel
+def pack_halo(grid_v: ti.template(), grid_m: ti.template(), buf: ti.types.ndarray(),
+              col_start: int, row_start: int):
+    # col_start, row_start are global
+    for i, j in ti.ndrange(buf.shape[0], buf.shape[1]):
+        I = ti.Vector([col_start + i, row_start + j]) - grid_origin[None]
+        buf[i, j, 0] = grid_m[I]
+        buf[i, j, 1] = grid_v[I].x
+        buf[i, j, 2] = grid_v[I].y
+
+
+@ti.kernel
+def unpack_halo(grid_v: ti.template(), grid_m: ti.template(), buf: ti.types.ndarray(),
+                col_start: int, row_start: int):
+    for i, j in ti.ndrange(buf.shape[0], buf.shape[1]):
+        # empty cells are skipped so a sparse grid stays sparse
+        if buf[i, j, 0] != 0:
+            I = ti.Vector([col_start + i, row_start + j]) - grid_origin[None]
+            grid_m[I] += buf[i, j, 0]
+            grid_v[I] += ti.Vector([buf[i, j, 1], buf[i, j, 2]])
+
+
+def grid_region():
+    # cells g_cal updates on this rank: the owned block plus its ghost
+    # cells, clipped to the domain, as (col_begin, col_end, row_begin, row_end)
+    return (max(x_bounds[cx] - halo, 0), min(x_bounds[cx+1] + halo, n_grid),
+            max(y_bounds[cy] - halo, 0), min(y_bounds[cy+1] + halo, n_grid))
+
+
+def fit_grid():
+    global grid_v, grid_m, grid_tree, grid_shape
+    # move the local grid over grid_region after the bounds change. It only
+    # grows, by a quarter more than needed, so drifting bounds rarely
+    # reallocate (and recompile the grid kernels for the new fields).
+    col_begin, col_end, row_begin, row_end = grid_region()
+    shape = (col_end - col_begin, row_end - row_begin)
+    if grid_tree is None or shape[0] > grid_shape[0] or shape[1] > grid_shape[1]:
+        if grid_tree is not None:
+            grid_tree.destroy()
+            shape = tuple(min(max(n, size) + n // 4, n_grid) for n, size in zip(shape, grid_shape))
+            print('{} grow grid {} -> {}'.format(rank, grid_shape, shape), flush=True)
+        grid_shape = shape
+        grid_v, grid_m, grid_tree = allocate_grid(grid_shape)
+    grid_origin[None] = [col_begin, row_begin]
+
+
+fit_grid()
+
+
+def grid_columns():
+    # split grid_region into the interior only this rank scatters into and
+    # the border strips that wait for a neighbour's halo
+    col_begin, col_end, row_begin, row_end = grid_region()
+    inner = [col_begin, col_end, row_begin, row_end]
+    if (-1, 0) in neighbours:
+        inner[0] = x_bounds[cx] + halo
+    if (1, 0) in neighbours:
+        inner[1] = x_bounds[cx+1] - halo
+    if (0, -1) in neighbours:
+        inner[2] = y_bounds[cy] + halo
+    if (0, 1) in neighbours:
+        inner[3] = y_bounds[cy+1] - halo
+    border = [
+        (col_begin, inner[0], row_begin, row_end),
+        (inner[1], col_end, row_begin, row_end),
+        (inner[0], inner[1], row_begin, inner[2]),
+        (inner[0], inner[1], inner[3], row_end),
+    ]
+    return tuple(inner), [b for b in border if b[0] < b[1] and b[2] < b[3]]
+
+
+def sync_grid_begin(it, axis):
+    # Both neighbours along axis scatter into the 2 * halo cells around
+    # their shared border, so each side ships its partial (m, vx, vy) for
+    # that strip and adds the other's. Afterwards both copies hold the full
+    # sum, which g2p needs when it reads the ghost cells. The strips span
+    # the ghost cells of the other axis too; exchanging x first and then y
+    # carries the diagonal neighbours' contributions into the corners.
+    col_begin, col_end, row_begin, row_end = grid_region()
+    bounds, coord = (x_bounds, cx) if axis == 0 else (y_bounds, cy)
+
+    pending = []
+    for side, border in ((-1, bounds[coord]), (1, bounds[coord+1])):
+        offset = (side, 0) if axis == 0 else (0, side)
+        if offset not in neighbours:
+            continue
+        if axis == 0:
+            start = (border - halo, row_begin)
+            shape = (2 * halo, row_end - row_begin, 3)
+        else:
+            start = (col_begin, border - halo)
+            shape = (col_end - col_begin, 2 * halo, 3)
+        if halo_staleness:
+            send_buf = np.empty(shape, dtype=np.float32)
+            pack_halo(grid_v, grid_m, send_buf, *start)
+            message = halo_message(send_buf)
+            # finished sends let go of their buffers
+            halo_sends[:] = [(req, buf) for req, buf in halo_sends if not req.Test()]
+            halo_sends.append((comm.Isend(message, dest=neighbours[offset], tag=TAG_GRID_ASYNC + axis),
+                               message))
+            pending.append(([], send_buf, None, start, (it, axis, side, offset, shape)))
+            continue
+        if offset in shared_neighbours:
+            # my strip towards side goes to slot (side + 1) // 2, the
+            # neighbour's strip towards me is in the opposite slot
+            size = shape[0] * shape[1] * 3
+            send_buf = halo_slots[node_rank][axis, (side + 1) // 2, :size].reshape(shape)
+            recv_buf = halo_slots[shared_neighbours[offset]][axis, (1 - side) // 2, :size].reshape(shape)
+            pack_halo(grid_v, grid_m, send_buf, *start)
+            pending.append(([], send_buf, recv_buf, start, None))
+            continue
+        send_buf = np.empty(shape, dtype=np.float32)
+        recv_buf = halo_inbox(shape)
+        pack_halo(grid_v, grid_m, send_buf, *start)
+        requests = [comm.Irecv(recv_buf, source=neighbours[offset], tag=TAG_GRID),
+                    comm.Isend(halo_message(send_buf), dest=neighbours[offset], tag=TAG_GRID)]
+        pending.append((requests, send_buf, recv_buf, start, None))
+    if shared_halo:
+        # every rank of the node takes part, neighbours on it or not
+        halo_win.Sync()
+        pending.append(([node_comm.Ibarrier()], None, None, None, None))
+    return pending
+
+
+def sync_grid_end(pending):
+    MPI.Request.Waitall([req for requests, *_ in pending for req in requests])
+    if shared_halo:
+        halo_win.Sync()
+    for requests, send_buf, recv_buf, start, stale in pending:
+        if stale is not None:
+            recv_buf = stale_halo(*stale)
+        elif recv_buf is not None and recv_buf.dtype == np.uint8:
+            recv_buf = wire.decode_halo(recv_buf, send_buf.shape)
+        if recv_buf is not None:
+            unpack_halo(grid_v, grid_m, recv_buf, *start)
+
+
+def halo_message(strip):
+    # what goes on the wire for a packed strip; the request of the send
+    # keeps the message alive until it completes
+    message = wire.encode_halo(strip, wire_half) if wire_format == 'compact' else strip
+    wire_stats['halo_bytes'] += message.nbytes
+    wire_stats['halo_raw'] += strip.nbytes
+    return message
+
+
+def halo_inbox(shape):
+    if wire_format == 'compact':
+        return np.empty(wire.halo_bound(shape), dtype=np.uint8)
+    return np.empty(shape, dtype=np.float32)
+
+
+def receive_halos(channel, until):
+    # strips arrive in substep order; take in what is there, and wait for
+    # everything up to substep until
+    source, tag = channel['source'], TAG_GRID_ASYNC + channel['axis']
+    while channel['next'] <= until or comm.Iprobe(source=source, tag=tag):
+        buf = halo_inbox(channel['shape'])
+        comm.Recv(buf, source=source, tag=tag)
+        if wire_format == 'compact':
+            buf = wire.decode_halo(buf, channel['shape'])
+        channel['inbox'][channel['next']] = buf
+        channel['next'] += 1
+
+
+def late_halo(channel, step):
+    # the real strip of a substep that ran on an estimate
+    exact = channel['inbox'].pop(step)
+    momentum = exact[..., 1:]
+    wrong = momentum - channel['estimates'].pop(step)[..., 1:]
+    if halo_error == 'max':
+        value = np.abs(wrong).max(initial=0.0)
+    elif halo_error == 'rms':
+        value = np.sqrt(np.mean(wrong ** 2)) if wrong.size else 0.0
+    else:
+        value = np.linalg.norm(wrong) / max(np.linalg.norm(momentum), 1e-30)
+    halo_stats['halo_error'] = max(halo_stats['halo_error'], float(value))
+    channel['latest'] = exact
+
+
+def stale_halo(it, axis, side, offset, shape):
+    key = axis, side
+    if key not in halo_channels:
+        halo_channels[key] = {'source': neighbours[offset], 'axis': axis, 'shape': shape, 'next': it,
+                              'inbox': {}, 'estimates': {}, 'latest': None}
+    channel = halo_channels[key]
+    receive_halos(channel, it - halo_staleness)
+    for step in sorted(step for step in channel['inbox'] if step < it):
+        late_halo(channel, step)
+    if it in channel['inbox']:
+        strip = channel['latest'] = channel['inbox'].pop(it)
+    else:
+        # the neighbour's newest strip stands in, nothing before its first
+        strip = channel['latest'] if channel['latest'] is not None else np.zeros(shape, dtype=np.float32)
+        channel['estimates'][it] = strip
+        halo_stats['halo_stale'] += 1
+    return strip
+
+
+def drain_halos(it):
+    # before the bounds, and with them the strip shapes, change: take in
+    # every strip sent before substep it and start the channels over
+    for channel in halo_channels.values():
+        receive_halos(channel, it - 1)
+        for step in sorted(channel['estimates']):
+            late_halo(channel, step)
+    halo_channels.clear()
+    MPI.Request.Waitall([req for req, buf in halo_sends])
+    halo_sends.clear()
+
+
+@ti.func
+def owner(xp, x_edges: ti.template(), y_edges: ti.template(), block_ranks: ti.template()):
+    # rank of the block xp is in, looked up from the block bounds; a
+    # particle past the domain edge belongs to the edge block
+    cell = xp / dx
+    bx, by = 0, 0
+    for i in range(1, x_edges.shape[0] - 1):
+        if cell.x >= x_edges[i]:
+            bx = i
+    for j in range(1, y_edges.shape[0] - 1):
+        if cell.y >= y_edges[j]:
+            by = j
+    return block_ranks[bx, by]
+
+
+@ti.kernel
+def count_outgoing(x: ti.template(), particle_count: int, x_edges: ti.types.ndarray(),
+                   y_edges: ti.types.ndarray(), block_ranks: ti.types.ndarray()):
+    for d in send_count:
+        send_count[d] = 0
+    for p in range(particle_count):
+        send_count[owner(x[p], x_edges, y_edges, block_ranks)] += 1
+
+
+@ti.func
+def store_record(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+                 pid: ti.template(), p, buf: ti.template(), slot):
+    # one particle as a row of frame_io.CHECKPOINT_WIDTH floats; the last
+    # holds the bits of pid
+    for a in ti.static(range(2)):
+        buf[slot, a] = x[p][a]
+        buf[slot, 2 + a] = v[p][a]
+        for b in ti.static(range(2)):
+            buf[slot, 4 + 2 * a + b] = C[p][a, b]
+    buf[slot, 8] = J[p]
+    buf[slot, 9] = ti.bit_cast(pid[p], ti.f32)
+
+
+@ti.kernel
+def pack_outgoing(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+                  pid: ti.template(), particle_count: int, stay_count: int, x_edges: ti.types.ndarray(),
+                  y_edges: ti.types.ndarray(), block_ranks: ti.types.ndarray(),
+                  cursor: ti.types.ndarray(), out: ti.types.ndarray(),
+                  holes: ti.types.ndarray(), movers: ti.types.ndarray()):
+    # outgoing particles are copied out as records grouped by destination;
+    # the slots they free below stay_count are paired with the staying
+    # particles above it, which compact_particles then moves down
+    for k in compact_count:
+        compact_count[k] = 0
+    for p in range(particle_count):
+        d = owner(x[p], x_edges, y_edges, block_ranks)
+        if d != rank:
+            store_record(x, v, C, J, pid, p, out, ti.atomic_add(cursor[d], 1))
+            if p < stay_count:
+                holes[ti.atomic_add(compact_count[0], 1)] = p
+        elif p >= stay_count:
+            movers[ti.atomic_add(compact_count[1], 1)] = p
+
+
+@ti.kernel
+def compact_particles(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+                      pid: ti.template(), holes: ti.types.ndarray(), movers: ti.types.ndarray(), count: int):
+    for k in range(count):
+        x[holes[k]] = x[movers[k]]
+        v[holes[k]] = v[movers[k]]
+        C[holes[k]] = C[movers[k]]
+        J[holes[k]] = J[movers[k]]
+        pid[holes[k]] = pid[movers[k]]
+
+
+@ti.kernel
+def append_records(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+                   pid: ti.template(), start: int, records: ti.types.ndarray()):
+    for k in range(records.shape[0]):
+        p = start + k
+        x[p] = [records[k, 0], records[k, 1]]
+        v[p] = [records[k, 2], records[k, 3]]
+        C[p] = [[records[k, 4], records[k, 5]], [records[k, 6], records[k, 7]]]
+        J[p] = records[k, 8]
+        pid[p] = ti.bit_cast(records[k, 9], ti.i32)
+
+
+@ti.kernel
+def copy_particles(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+                   pid: ti.template(), new_x: ti.template(), new_v: ti.template(),
+                   new_C: ti.template(), new_J: ti.template(), new_pid: ti.template(),
+                   particle_count: int):
+    for p in range(particle_count):
+        new_x[p] = x[p]
+        new_v[p] = v[p]
+        new_C[p] = C[p]
+        new_J[p] = J[p]
+        new_pid[p] = pid[p]
+
+
+def grow_particles(needed):
+    global x, v, C, J, pid, particle_tree, particle_capacity
+    capacity = max(2 * particle_capacity, needed)
+    print('{} grow particles {} -> {}'.format(rank, particle_capacity, capacity), flush=True)
+    new_x, new_v, new_C, new_J, new_pid, new_tree = allocate_particles(capacity)
+    copy_particles(x, v, C, J, pid, new_x, new_v, new_C, new_J, new_pid, cur_particle_num)
+    particle_tree.destroy()
+    x, v, C, J, pid, particle_tree = new_x, new_v, new_C, new_J, new_pid, new_tree
+    particle_capacity = capacity
+
+
+def block_layout():
+    # what owner() needs: the block bounds and the rank of every block
+    return (np.array(x_bounds, dtype=np.int32), np.array(y_bounds, dtype=np.int32),
+            np.array([[cart.Get_cart_rank([i, j]) for j in range(proc_dims[1])]
+                      for i in range(proc_dims[0])], dtype=np.int32))
+
+
+def transfer_begin(it):
+    # every particle goes straight to the rank whose block it is in, however
+    # many blocks it crossed: an Alltoall of the message sizes, then an
+    # Alltoallv of the packed records. This packs the leaving particles,
+    # compacts the staying ones and starts the size exchange.
 
-def transfer_particle(it):
     global cur_particle_num
-    TAG = ("{}-{}".format(it, 1))
-    TAG = int(hashlib.sha1(TAG.encode("utf-8")).hexdigest(), 16) % 1000009
-
-    x_grid_left_border = n_grid // n_nodes * rank * dx
-    x_grid_right_border = n_grid // n_nodes * (rank+1) * dx
-
-    current_particle_x = x.to_numpy()
-    current_particle_v = v.to_numpy()
-    current_particle_C = C.to_numpy()
-    current_particle_J = J.to_numpy()
-
-    # check which particle is beyond border
-    left_index = current_particle_x[:, 0] < x_grid_left_border
-    right_index = current_particle_x[:, 0] >= x_grid_right_border
-    conserved_index = (current_particle_x[:, 0] >= x_grid_left_border) & (current_particle_x[:, 0] < x_grid_right_border)
-
-    # prepare transfered data
-    left_x_transfer = current_particle_x[left_index, :]
-    left_v_transfer = current_particle_v[left_index, :]
-    left_J_transfer = current_particle_J[left_index, :]
-    left_C_transfer = current_particle_C[left_index, :]
-    left = [left_x_transfer, left_v_transfer, left_J_transfer, left_C_transfer]
-    # print('left send data', it, rank, left_x_transfer.shape, flush=True)
-    right_x_transfer = current_particle_x[right_index, :]
-    right_v_transfer = current_particle_v[right_index, :]
-    right_J_transfer = current_particle_J[right_index, :]
-    right_C_transfer = current_particle_C[right_index, :]
-    right = [right_x_transfer, right_v_transfer, right_J_transfer, right_C_transfer]
-    # print('right send data', it, rank, right_x_transfer.shape,  flush=True)
-    remain_x = current_particle_x[conserved_index, :]
-    remain_v = current_particle_v[conserved_index, :]
-    remain_J = current_particle_J[conserved_index, :]
-    remain_C = current_particle_C[conserved_index, :]
-
-    left_req, right_req = None, None
-    if rank > 0:
-        left_req = comm.irecv(source=rank - 1, tag=TAG)
-    if rank < n_nodes - 1:
-        right_req = comm.irecv(source=rank + 1, tag=TAG)
-    if rank > 0:
-        comm.send(left, dest=rank-1, tag=TAG)
-    if rank < n_nodes - 1:
-        comm.send(right, dest=rank+1, tag=TAG)
-
-    if left_req:
-        data = left_req.wait()
-        # if data:
-        #     print('left data', it, rank, data,  flush=True)
-        new_x, new_v, new_J, new_C = data
-        # print("???? left", new_x.shape, new_v.shape)
-        if new_x.shape[0] > 0:
-            remain_x = np.hstack([remain_x, new_x])
-            remain_v = np.hstack([remain_v, new_v])
-            remain_J = np.hstack([remain_J, new_J])
-            remain_C = np.hstack([remain_C, new_C])
-
-    if right_req:
-
-        data = right_req.wait()
-        new_x, new_v, new_J, new_C = data
-        # if data:
-        #     print('right data', it, rank, data, flush=True)
-        # print("???? right", new_x.shape, new_v.shape)
-        if new_x.shape[0] > 0:
-            remain_x = np.hstack([remain_x, new_x])
-            remain_v = np.hstack([remain_v, new_v])
-            remain_J = np.hstack([remain_J, new_J])
-            remain_C = np.hstack([remain_C, new_C])
-
-    cur_particle_num = remain_x.shape[0]
-    x.from_numpy(remain_x)
-    v.from_numpy(remain_v)
-    J.from_numpy(remain_J)
-    C.from_numpy(remain_C)
+    # partition on the device; only the outgoing particles reach the host
+    layout = block_layout()
+    count_outgoing(x, cur_particle_num, *layout)
+    counts = send_count.to_numpy()
+    stay_count = int(counts[rank])
+    counts[rank] = 0
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+    sent = int(offsets[-1])
+    records = np.empty((sent, frame_io.CHECKPOINT_WIDTH), dtype=np.float32)
+    if sent > 0:
+        holes = np.empty(sent, dtype=np.int32)
+        movers = np.empty(sent, dtype=np.int32)
+        pack_outgoing(x, v, C, J, pid, cur_particle_num, stay_count, *layout, offsets[:-1].copy(),
+                      records, holes, movers)
+        holes_count = int(compact_count[0])
+        if holes_count > 0:
+            compact_particles(x, v, C, J, pid, holes, movers, holes_count)
 
+    wire_stats['particle_raw'] += records.nbytes
+    if wire_format == 'compact':
+        # one encoded message per destination, none to ranks getting nothing
+        messages = [wire.encode_particles(records[offsets[d]:offsets[d+1]], wire_half) if counts[d] > 0
+                    else np.empty(0, dtype=np.uint8) for d in range(n_nodes)]
+        send_buf = np.concatenate(messages)
+        send_sizes = np.array([message.size for message in messages], dtype=np.int32)
+        datatype = MPI.BYTE
+    else:
+        send_buf = records
+        send_sizes = (counts * frame_io.CHECKPOINT_WIDTH).astype(np.int32)
+        datatype = MPI.FLOAT
+    wire_stats['particle_bytes'] += send_buf.nbytes
+    recv_sizes = np.empty(n_nodes, dtype=np.int32)
+    cur_particle_num = stay_count
+    return {'sent': sent, 'stay_count': stay_count, 'send_buf': send_buf, 'send_sizes': send_sizes,
+            'datatype': datatype, 'recv_sizes': recv_sizes, 'recv_buf': None,
+            'request': comm.Ialltoall(send_sizes, recv_sizes)}
 
-def substep(it, debug=False):
-    it_start = time.time()
-    p2g(cur_particle_num)
-    print('{}-{} p2g cost {}'.format(it, rank, time.time() -it_start))
-    sync_grid(it)
-    print('{}-{} sync cost {}'.format(it, rank, time.time() - it_start))
-    # ti.kernel_profiler_print()
-    g_cal()
-    print('{}-{} gcal cost {}'.format(it, rank, time.time() - it_start))
-    # ti.kernel_profiler_print()
-    g2p(cur_particle_num)
-    print('{}-{} g2p cost {}'.format(it, rank, time.time() - it_start))
 
+def transfer_exchange(transfer):
+    # the records go out once the sizes are known
+    transfer['request'].Wait()
+    send_sizes, recv_sizes = transfer['send_sizes'], transfer['recv_sizes']
+    recv_offsets = np.concatenate([[0], np.cumsum(recv_sizes)]).astype(np.int32)
+    recv_buf = np.empty(int(recv_offsets[-1]), dtype=transfer['send_buf'].dtype)
+    datatype = transfer['datatype']
+    transfer['request'] = comm.Ialltoallv(
+        [transfer['send_buf'], (send_sizes, np.cumsum(send_sizes) - send_sizes), datatype],
+        [recv_buf, (recv_sizes, recv_offsets[:-1]), datatype])
+    transfer['recv_buf'], transfer['recv_offsets'] = recv_buf, recv_offsets
+
+
+def transfer_end(transfer):
+    # appends the arrivals behind the staying particles; returns where
+    # they start
+    global cur_particle_num
+    if transfer['recv_buf'] is None:
+        transfer_exchange(transfer)
+    transfer['request'].Wait()
+    recv_buf, recv_offsets = transfer['recv_buf'], transfer['recv_offsets']
+    if wire_format == 'compact':
+        received = [wire.decode_particles(recv_buf[recv_offsets[r]:recv_offsets[r+1]])
+                    for r in range(n_nodes) if recv_offsets[r+1] > recv_offsets[r]]
+        received = np.concatenate(received) if received else \
+            np.empty((0, frame_io.CHECKPOINT_WIDTH), dtype=np.float32)
+    else:
+        received = recv_buf.reshape((-1, frame_io.CHECKPOINT_WIDTH))
+
+    if cur_particle_num + received.shape[0] > particle_capacity:
+        grow_particles(cur_particle_num + received.shape[0])
+    if received.shape[0] > 0:
+        append_records(x, v, C, J, pid, cur_particle_num, received)
+        cur_particle_num += received.shape[0]
+    return transfer['stay_count']
+
+
+def transfer_particle(it):
+    transfer = transfer_begin(it)
+    transfer_end(transfer)
+    return transfer['sent']
+
+
+@ti.func
+def sort_key(xp):
+    cell = ti.min(ti.max(int(xp / dx), 0), n_grid - 1)
+    if ti.static(sort_by == 'block'):
+        cell //= grid_block
+    return cell.x * sort_width + cell.y
+
+
+@ti.kernel
+def reorder_particles(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+                      pid: ti.template(), new_x: ti.template(), new_v: ti.template(),
+                      new_C: ti.template(), new_J: ti.template(), new_pid: ti.template(),
+                      particle_count: int):
+    for k in sort_count:
+        sort_count[k] = 0
+    for p in range(particle_count):
+        sort_count[sort_key(x[p])] += 1
+    # counts to first slots; serial, but only over the keys
+    total = 0
+    ti.loop_config(serialize=True)
+    for k in range(sort_width * sort_width):
+        count = sort_count[k]
+        sort_count[k] = total
+        total += count
+    for p in range(particle_count):
+        slot = ti.atomic_add(sort_count[sort_key(x[p])], 1)
+        new_x[slot] = x[p]
+        new_v[slot] = v[p]
+        new_C[slot] = C[p]
+        new_J[slot] = J[p]
+        new_pid[slot] = pid[p]
+
+
+def sort_particles():
+    global x, v, C, J, pid, particle_tree, sort_buffers
+    if sort_buffers is None or sort_buffers[0].shape[0] != particle_capacity:
+        # (re)allocated on first use and after grow_particles
+        if sort_buffers is not None:
+            sort_buffers[5].destroy()
+        sort_buffers = allocate_particles(particle_capacity)
+    new_x, new_v, new_C, new_J, new_pid, new_tree = sort_buffers
+    reorder_particles(x, v, C, J, pid, new_x, new_v, new_C, new_J, new_pid, cur_particle_num)
+    sort_buffers = (x, v, C, J, pid, particle_tree)
+    x, v, C, J, pid, particle_tree = new_x, new_v, new_C, new_J, new_pid, new_tree
+
+
+@ti.kernel
+def max_speed(v: ti.template(), particle_count: int):
+    speed_max[None] = 0
+    for p in range(particle_count):
+        ti.atomic_max(speed_max[None], v[p].norm())
+
+
+def migration_interval():
+    # substeps until the fastest particle anywhere could cross the skin
+    if skin == 0:
+        return 1
+    max_speed(v, cur_particle_num)
+    speed = comm.allreduce(speed_max[None], op=MPI.MAX)
+    if speed * dt * max_migration_interval <= skin_safety * skin * dx:
+        return max_migration_interval
+    return max(1, int(skin_safety * skin * dx / (speed * dt)))
+
+
+def settle_particles(it):
+    # particles go straight to their block, so one round settles them all
     transfer_particle(it)
-    print('{}-{} transfer cost {}'.format(it, rank, time.time() - it_start))
+
+
+@ti.kernel
+def count_cells(x: ti.template(), particle_count: int):
+    for i in column_load:
+        column_load[i] = 0
+        row_load[i] = 0
+    for p in range(particle_count):
+        cell = ti.min(ti.max(int(x[p] / dx), 0), n_grid - 1)
+        column_load[cell.x] += 1
+        row_load[cell.y] += 1
+
+
+def balanced_bounds(local_load, parts):
+    # sum the per-rank histograms and cut the total into parts pieces of
+    # equal load, each at least 2 * halo cells wide so halos never overlap
+    load = np.zeros_like(local_load)
+    comm.Allreduce(local_load, load, op=MPI.SUM)
+    cumulative = np.cumsum(load)
+    targets = cumulative[-1] * np.arange(1, parts) / parts
+    bounds = [0] + [int(b) + 1 for b in np.searchsorted(cumulative, targets)] + [n_grid]
+    min_width = 2 * halo
+    for r in range(1, parts):
+        bounds[r] = max(bounds[r], bounds[r-1] + min_width)
+    for r in range(parts - 1, 0, -1):
+        bounds[r] = min(bounds[r], bounds[r+1] - min_width)
+    return bounds
+
+
+def rebalance(it):
+    global particle_time
+    if halo_staleness:
+        drain_halos(it)
+    # column and row histograms of all particles set the x and y cuts; in
+    # 'time' mode each rank's particles weigh its measured cost per particle
+    count_cells(x, cur_particle_num)
+    weight = 1.0
+    if rebalance_by == 'time' and cur_particle_num > 0 and particle_time > 0:
+        weight = particle_time / cur_particle_num
+    particle_time = 0.0
+    x_bounds[:] = balanced_bounds(column_load.to_numpy() * weight, proc_dims[0])
+    y_bounds[:] = balanced_bounds(row_load.to_numpy() * weight, proc_dims[1])
+    fit_grid()
+    if rank == 0:
+        print('{} rebalance blocks x {} y {}'.format(it, x_bounds, y_bounds), flush=True)
+    settle_particles(it)
+
+
+def record(phase, start):
+    if profile_sync or rebalance_by == 'time':
+        ti.sync()
+    now = time.perf_counter()
+    phase_time[phase] += now - start
+    return now
+
+
+def report_phases(frame, substeps, wall):
+    counters = dict(wire_stats, **(halo_stats if halo_staleness else {}))
+    stats = ('particles', 'wall') + tuple(counters)
+    local = np.array([phase_time[phase] for phase in phases] + [cur_particle_num, wall]
+                     + list(counters.values()), dtype=np.float64)
+    low, high, total = np.zeros_like(local), np.zeros_like(local), np.zeros_like(local)
+    comm.Reduce(local, low, op=MPI.MIN, root=0)
+    comm.Reduce(local, high, op=MPI.MAX, root=0)
+    comm.Reduce(local, total, op=MPI.SUM, root=0)
+    for phase in phases:
+        phase_time[phase] = 0.0
+    for counter in (halo_stats, wire_stats):
+        for name in counter:
+            counter[name] = 0.0
+    if rank != 0:
+        return
+    # imbalance is max / mean: 1 when every rank takes equally long
+    report = {'frame': frame, 'substeps': substeps, 'ranks': n_nodes}
+    for k, name in enumerate(phases + stats):
+        mean = total[k] / n_nodes
+        report[name] = {'min': low[k], 'mean': mean, 'max': high[k],
+                        'imbalance': high[k] / mean if mean > 0 else 1.0}
+    with open(profile_path, 'a') as f:
+        f.write(json.dumps(report) + '\n')
+
+
+def finish_migration(it):
+    # appends a pending migration's arrivals without splatting them
+    global pending_transfer, next_migration
+    if pending_transfer is not None:
+        transfer_end(pending_transfer)
+        pending_transfer = None
+        next_migration = it + migration_interval()
+
+
+def substep(it, debug=False):
+    global particle_time, next_migration, pending_transfer
+    mark = time.perf_counter()
+    rebalance_due = rebalance_interval and it > 0 and it % rebalance_interval == 0
+    sort_due = sort_interval and it % sort_interval == 0
+    if rebalance_due or sort_due:
+        finish_migration(it)
+        mark = record('transfer', mark)
+    if rebalance_due:
+        rebalance(it)
+        next_migration = it + migration_interval()
+        mark = record('rebalance', mark)
+    if sort_due:
+        sort_particles()
+        mark = record('sort', mark)
+    if pending_transfer is not None:
+        transfer_exchange(pending_transfer)
+        mark = record('transfer', mark)
+        p2g(x, v, C, J, grid_v, grid_m, cur_particle_num)
+        p2g_done = record('p2g', mark)
+        particle_time += p2g_done - mark
+        start = transfer_end(pending_transfer)
+        pending_transfer = None
+        next_migration = it + migration_interval()
+        mark = record('transfer', p2g_done)
+        p2g_arrivals(x, v, C, J, grid_v, grid_m, start, cur_particle_num)
+        p2g_done = record('p2g', mark)
+        particle_time += p2g_done - mark
+    else:
+        p2g(x, v, C, J, grid_v, grid_m, cur_particle_num)
+        p2g_done = record('p2g', mark)
+        particle_time += p2g_done - mark
+    # the x halo is in flight while the interior cells are updated; the y
+    # halo carries the corners, so it has to wait for the x halo
+    pending = sync_grid_begin(it, 0)
+    inner, border = grid_columns()
+    mark = record('sync_grid', p2g_done)
+    g_cal(grid_v, grid_m, *inner)
+    mark = record('g_cal_inner', mark)
+    sync_grid_end(pending)
+    sync_grid_end(sync_grid_begin(it, 1))
+    mark = record('sync_grid', mark)
+    for region in border:
+        g_cal(grid_v, grid_m, *region)
+    mark = record('g_cal', mark)
+    g2p(x, v, C, J, grid_v, cur_particle_num)
+    g2p_done = record('g2p', mark)
+    particle_time += g2p_done - mark
+
+    if it + 1 >= next_migration:
+        if pipelined_migration:
+            pending_transfer = transfer_begin(it)
+        else:
+            transfer_particle(it)
+            next_migration = it + 1 + migration_interval()
+        record('transfer', g2p_done)
 
 
 
 @ti.kernel
-def init(particle_count: int):
-    x_start = rank * n_grid // n_nodes * dx
-    x_end = (rank+1) * n_grid // n_nodes * dx
-    for i in range(n_particles):
+def init(x: ti.template(), v: ti.template(), J: ti.template(), pid: ti.template(),
+         particle_count: int, first_pid: int, x_start: float, x_end: float,
+         y_start: float, y_end: float):
+    for i in range(x.shape[0]):
+        pid[i] = first_pid + i
         if i < particle_count:
             x_random = ti.random() * (x_end - x_start)
-            x[i] = [x_random * 0.7 + x_start, ti.random() * 0.4 + 0.2]
+            x[i] = [x_random * 0.7 + x_start, ti.random() * (y_end - y_start) + y_start]
             v[i] = [0, -1]
             J[i] = 1
         else:
@@ -267,23 +1061,265 @@ def init(particle_count: int):
             v[i] = [0, 0]
             J[i] = 1
 
-def write_data(it, data):
-    np.savetxt('out4/{}-output-{}.txt'.format(rank, it), data, delimiter=",")
+def write_data(it, data, ids, out_comm=comm):
+    frame_io.write_frame(out_comm, output_dir, output_format, it, data, ids, **output_options)
+
+
+@ti.kernel
+def copy_positions(x: ti.template(), pid: ti.template(), buf: ti.types.ndarray(),
+                   ids: ti.types.ndarray(), particle_count: int):
+    for p in range(particle_count):
+        buf[p, 0] = x[p].x
+        buf[p, 1] = x[p].y
+        ids[p] = pid[p]
+
+
+def frame_buffers():
+    return np.empty((particle_capacity, 2), dtype=np.float32), np.empty(particle_capacity, dtype=np.int32)
+
+
+def writer_loop(out_comm):
+    global writer_error
+    while True:
+        frame = frame_queue.get()
+        if frame is None:
+            break
+        it, buf, ids, count = frame
+        try:
+            if writer_error is None:
+                write_data(it, buf[:count], ids[:count], out_comm)
+        except Exception as e:
+            writer_error = e
+        free_buffers.put((buf, ids))
+
+
+def start_writer():
+    global writer_thread, async_output
+    if output_format == 'none':
+        return
+    if async_output and MPI.Query_thread() < MPI.THREAD_MULTIPLE:
+        async_output = False
+    if not async_output:
+        return
+    for _ in range(2):
+        free_buffers.put(frame_buffers())
+    # the writer's collective MPI-IO runs on its own communicator so it
+    # never interleaves with the solver's messages
+    writer_thread = threading.Thread(target=writer_loop, args=(comm.Dup(),), daemon=True)
+    writer_thread.start()
+
+
+def submit_frame(it):
+    if output_format == 'none':
+        return
+    if not async_output:
+        write_data(it, x.to_numpy()[:cur_particle_num, :], pid.to_numpy()[:cur_particle_num])
+        return
+    buf, ids = free_buffers.get()
+    if writer_error is not None:
+        raise writer_error
+    if buf.shape[0] < cur_particle_num:
+        buf, ids = frame_buffers()
+    copy_positions(x, pid, buf, ids, cur_particle_num)
+    frame_queue.put((it, buf, ids, cur_particle_num))
+
+
+def drain_writer():
+    # both buffers back means every queued frame is on disk
+    if writer_thread is None:
+        return
+    buffers = [free_buffers.get() for _ in range(2)]
+    for buffer in buffers:
+        free_buffers.put(buffer)
+    if writer_error is not None:
+        raise writer_error
+
+
+def stop_writer():
+    if writer_thread is not None:
+        frame_queue.put(None)
+        writer_thread.join()
+        if writer_error is not None:
+            raise writer_error
+
+
+def gather_view(it):
+    global view_pending
+    if in_situ == 'none':
+        return
+    finish_view()
+    buf, ids = frame_buffers()
+    copy_positions(x, pid, buf, ids, cur_particle_num)
+    sample = np.ascontiguousarray(buf[:cur_particle_num][ids[:cur_particle_num] % in_situ_stride == 0])
+    counts = view_comm.gather(sample.shape[0], root=0)
+    data, recv = None, None
+    if rank == 0:
+        data = np.empty((sum(counts), 2), dtype=np.float32)
+        recv = [data, [2 * count for count in counts]]
+    view_pending = (it, view_comm.Igatherv(sample, recv, root=0), sample, data)
+
+
+def finish_view():
+    global view_pending, view_dropped
+    if view_pending is None:
+        return
+    it, request, sample, data = view_pending
+    request.Wait()
+    view_pending = None
+    if view_thread is not None:
+        # never wait on the view thread: a slow view skips frames
+        try:
+            view_queue.put_nowait((it, data))
+        except queue.Full:
+            view_dropped += 1
+
+
+def view_loop():
+    # after a failure the loop keeps draining the queue, so neither
+    # finish_view nor stop_view can block on it
+    global view_error
+    connection = None
+    while True:
+        frame = view_queue.get()
+        if frame is None:
+            break
+        if view_error is not None:
+            continue
+        it, data = frame
+        try:
+            if in_situ == 'png':
+                image = render_frames.rasterize(data, in_situ_size, 1.5)
+                render_frames.write_png(os.path.join(in_situ_target, 'frame-{:05d}.png'.format(it)), image)
+            else:
+                if connection is None:
+                    connection = socket.create_connection(in_situ_address)
+                frame_io.send_frame(connection, it, data)
+        except Exception as e:
+            view_error = e
+            print('in-situ view to {} failed at frame {}: {}'.format(in_situ_target, it, e), flush=True)
+    if connection is not None:
+        connection.close()
+
+
+def start_view():
+    global view_thread
+    if in_situ == 'none' or rank != 0:
+        return
+    if in_situ == 'png':
+        try:
+            os.makedirs(in_situ_target, exist_ok=True)
+        except OSError as e:
+            print('in-situ view to {} failed: {}'.format(in_situ_target, e), flush=True)
+            return
+    view_thread = threading.Thread(target=view_loop, daemon=True)
+    view_thread.start()
+
+
+def stop_view():
+    finish_view()
+    while view_thread is not None and view_thread.is_alive():
+        try:
+            view_queue.put(None, timeout=1)
+            view_thread.join()
+        except queue.Full:
+            pass
+    if view_dropped:
+        print('in-situ view dropped {} frames'.format(view_dropped), flush=True)
+
+
+@ti.kernel
+def pack_state(x: ti.template(), v: ti.template(), C: ti.template(), J: ti.template(),
+               pid: ti.template(), buf: ti.types.ndarray(), particle_count: int):
+    for p in range(particle_count):
+        store_record(x, v, C, J, pid, p, buf, p)
+
+
+def save_checkpoint(frame):
+    records = np.empty((cur_particle_num, frame_io.CHECKPOINT_WIDTH), dtype=np.float32)
+    if cur_particle_num > 0:
+        pack_state(x, v, C, J, pid, records, cur_particle_num)
+    frame_io.write_checkpoint(comm, checkpoint_path, frame, records)
+
+
+def load_checkpoint():
+    global cur_particle_num
+    # every rank takes an equal slice of the saved particles; settling or
+    # rebalancing afterwards moves them to the blocks that own them
+    frame, records = frame_io.read_checkpoint(checkpoint_path, rank, n_nodes)
+    cur_particle_num = 0
+    if records.shape[0] > particle_capacity:
+        grow_particles(records.shape[0])
+    if records.shape[0] > 0:
+        append_records(x, v, C, J, pid, 0, records)
+    cur_particle_num = records.shape[0]
+    return frame
+
 
 def iteration():
     print(rank, '---init-----', flush=True)
-    init(cur_particle_num)
+    os.makedirs(output_dir, exist_ok=True)
+    first_frame = 0
+    if restart and os.path.exists(checkpoint_path):
+        first_frame = load_checkpoint()
+        print(rank, '---restart from frame-----', first_frame, flush=True)
+        if rebalance_interval:
+            rebalance(first_frame * frame_substeps)
+        else:
+            settle_particles(first_frame * frame_substeps)
+    else:
+        # a fresh run starts a fresh profile; a restart adds to its run's
+        if rank == 0:
+            open(profile_path, 'w').close()
+        # every rank seeds its share into its own column of blocks and its
+        # own slice of the 0.2-0.6 water height, so no two ranks seed the
+        # same particles; settling hands the particles to the block that
+        # owns their row. Nothing is seeded inside the wall cells: particles
+        # there blow up and scatter outside the grid.
+        init(x, v, J, pid, cur_particle_num, comm.exscan(cur_particle_num) or 0,
+             max(x_bounds[cx], bound) * dx, x_bounds[cx+1] * dx,
+             0.2 + 0.4 * cy / proc_dims[1], 0.2 + 0.4 * (cy + 1) / proc_dims[1])
+        settle_particles(-1)
+    start_writer()
+    start_view()
     start_time = time.time()
-    for it in range(100):
+    for it in range(first_frame, n_frames):
         print(rank, '---it-----', it, flush=True)
-        for sub in range(50):
-            substep(it*50+sub)
+        frame_start = time.perf_counter()
+        for sub in range(frame_substeps):
+            substep(it*frame_substeps+sub)
+        finish_migration((it + 1) * frame_substeps)
+        report_phases(it, frame_substeps, time.perf_counter() - frame_start)
         print(rank, '---write data-----', it, flush=True)
-        data = x.to_numpy()
-        write_data(it, data[:cur_particle_num, :])
+        submit_frame(it)
+        gather_view(it)
+        if checkpoint_interval and (it + 1) % checkpoint_interval == 0:
+            # a restart resumes after the checkpoint, so its frames must be
+            # written first
+            drain_writer()
+            save_checkpoint(it + 1)
         print('{}-{} time %s seconds'.format(rank, it, time.time() - start_time))
+    if halo_staleness:
+        drain_halos(n_frames * frame_substeps)
+    stop_writer()
+    stop_view()
+    wall = comm.reduce(time.time() - start_time, op=MPI.MAX, root=0)
+    if rank == 0:
+        summary = {'summary': True, 'ranks': n_nodes, 'particles': n_particles, 'grid': n_grid,
+                   'frames': n_frames - first_frame, 'substeps': frame_substeps, 'wall': wall}
+        encoder = frame_io.delta_encoders.get(output_dir)
+        if encoder is not None:
+            # against the float32 positions the other binary formats write
+            summary['output_ratio'] = encoder['raw'] / max(encoder['stored'], 1)
+            summary['output_max_error'] = encoder['max_error']
+            print('delta output {:.1f}x smaller than float32, max error {:.3g}'.format(
+                summary['output_ratio'], summary['output_max_error']), flush=True)
+        with open(profile_path, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
     print('Finish! {} time {} seconds'.format(rank, time.time() - start_time))
 
-if __name__ == '__main__': iteration()
+if __name__ == '__main__':
+    if unknown_args:
+        parser.error('unrecognized arguments: {}'.format(' '.join(unknown_args)))
+    iteration()
 
 
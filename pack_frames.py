@@ -0,0 +1,30 @@
+import argparse
+import os
+import time
+
+import frame_io
+
+# Packs the frames main.py wrote into one archive (see frame_io) that the
+# viewer and tools read with --format archive, any frame without reading
+# the others.
+# usage: python pack_frames.py out4 out4.mpa --format txt
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pack a run\'s frames into one indexed archive')
+    parser.add_argument('input', help='main.py --output-dir')
+    parser.add_argument('output', help='archive to write')
+    parser.add_argument('--format', choices=frame_io.formats, default='txt', help='main.py --output-format')
+    parser.add_argument('--ranks', type=int, default=None, help='rank files per frame (default: all found)')
+    parser.add_argument('--level', type=int, default=6, help='zlib level, 0 = uncompressed')
+    parser.add_argument('--workers', type=int, default=2, help='reader threads')
+    args = parser.parse_args()
+
+    frames = frame_io.frame_numbers(args.input, args.format)
+    start = time.perf_counter()
+    frame_io.write_archive(args.output, frame_io.prefetch_frames(args.input, args.format, frames,
+                                                                 workers=args.workers, n_ranks=args.ranks),
+                           args.level)
+    before = sum(os.path.getsize(os.path.join(args.input, name)) for name in os.listdir(args.input))
+    after = os.path.getsize(args.output)
+    print('{} frames, {} -> {} bytes ({:.2f}) in {:.1f} seconds'.format(
+        len(frames), before, after, after / max(before, 1), time.perf_counter() - start))
@@ -0,0 +1,60 @@
+import json
+import sys
+
+# Turns the per-frame phase reports main.py writes to profile.jsonl into
+# the "sub method cost" table of the README: seconds per substep, averaged
+# over ranks (mean) and for the slowest rank (max). A fresh run starts the
+# file over and a --restart adds to it, so it holds one run.
+# usage: python profile_table.py [profile.jsonl] [frames to skip]
+
+
+def load_reports(path, skip=1):
+    # the first frame pays for kernel compilation, so it is skipped
+    with open(path) as f:
+        reports = [json.loads(line) for line in f if line.strip()]
+    return [report for report in reports if 'frame' in report][skip:]
+
+
+# per-frame entries of a report that are not phase timings
+stats = ('particles', 'wall', 'halo_stale', 'halo_error',
+         'halo_bytes', 'halo_raw', 'particle_bytes', 'particle_raw')
+
+
+def phase_names(report):
+    return [name for name, value in report.items() if isinstance(value, dict) and name not in stats]
+
+
+def phase_table(reports):
+    phases = phase_names(reports[0])
+    substeps = sum(report['substeps'] for report in reports)
+    lines = ['| sub method cost ({} ranks, {} substeps) | mean (secs) | max (secs) | imbalance |'.format(
+                 reports[0]['ranks'], substeps),
+             '| --- | ----------- | ----------- | ----------- |']
+    for phase in phases:
+        mean = sum(report[phase]['mean'] for report in reports) / substeps
+        high = sum(report[phase]['max'] for report in reports) / substeps
+        lines.append('| {} | {:.3g} | {:.3g} | {:.2f} |'.format(
+            phase, mean, high, high / mean if mean > 0 else 1.0))
+    return '\n'.join(lines)
+
+
+def wire_table(reports):
+    # bytes all ranks send per substep, against plain float32 messages
+    substeps = sum(report['substeps'] for report in reports)
+    lines = ['| messages | bytes per substep | float32 bytes per substep | ratio |',
+             '| --- | ----------- | ----------- | ----------- |']
+    for kind in ('halo', 'particle'):
+        sent, raw = (sum(report[kind + suffix]['mean'] * report['ranks'] for report in reports) / substeps
+                     for suffix in ('_bytes', '_raw'))
+        lines.append('| {} | {:.0f} | {:.0f} | {:.2f} |'.format(kind, sent, raw, sent / raw if raw > 0 else 1.0))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'profile.jsonl'
+    skip = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    reports = load_reports(path, skip)
+    print(phase_table(reports))
+    if 'halo_bytes' in reports[0]:
+        print()
+        print(wire_table(reports))
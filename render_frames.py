@@ -0,0 +1,109 @@
+import argparse
+import os
+import shutil
+import struct
+import subprocess
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import frame_io
+
+# Renders the frames main.py wrote to PNG files without a display: a
+# numpy rasterizer draws the particles as discs in the colours of the
+# check_read.py viewer, and a process pool renders several frames at
+# once. With --mp4 and ffmpeg on the PATH the PNGs are also encoded into a
+# video.
+# usage: python render_frames.py out4 --format txt --out frames --mp4 out4.mp4
+
+background = (0x11, 0x2F, 0x41)
+particle = (0x06, 0x85, 0x87)
+
+
+def write_png(path, image):
+    # 8-bit RGB, no filtering; zlib does the work
+    height, width, _ = image.shape
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), image.reshape((height, -1))])
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def disc(radius):
+    # pixel offsets covered by a particle
+    span = np.arange(-int(radius), int(radius) + 1)
+    dy, dx = np.meshgrid(span, span, indexing='ij')
+    inside = dx ** 2 + dy ** 2 <= radius ** 2
+    return dy[inside], dx[inside]
+
+
+def rasterize(data, size, radius):
+    # positions in [0, 1)^2, y up as in ti.GUI
+    image = np.empty((size, size, 3), dtype=np.uint8)
+    image[:] = background
+    px = (data[:, 0] * size).astype(np.int64)
+    py = ((1 - data[:, 1]) * size).astype(np.int64)
+    dy, dx = disc(radius)
+    rows = (py[:, None] + dy[None, :]).ravel()
+    cols = (px[:, None] + dx[None, :]).ravel()
+    keep = (rows >= 0) & (rows < size) & (cols >= 0) & (cols < size)
+    image[rows[keep], cols[keep]] = particle
+    return image
+
+
+def render(directory, fmt, it, path, size, radius):
+    data, _ = frame_io.read_frame(directory, fmt, it)
+    write_png(path, rasterize(data, size, radius))
+    return path
+
+
+def encode_mp4(images, path, fps):
+    encoder = shutil.which('ffmpeg')
+    if encoder is None:
+        print('ffmpeg not found, no {}'.format(path))
+        return
+    # a concat list, since frame numbers need not start at 0 or follow on
+    # from each other after a restart
+    listing = path + '.txt'
+    with open(listing, 'w') as f:
+        for image in images:
+            f.write("file '{}'\nduration {}\n".format(os.path.abspath(image), 1 / fps))
+    subprocess.run([encoder, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', listing,
+                    '-r', str(fps), '-c:v', 'libx264', '-pix_fmt', 'yuv420p', path], check=True)
+    os.remove(listing)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='render main.py frames to PNG (and MP4) without a display')
+    parser.add_argument('input', help='main.py --output-dir, or a pack_frames.py archive')
+    parser.add_argument('--format', choices=frame_io.formats + ('archive',), default='txt')
+    parser.add_argument('--out', default='frames', help='directory for frame-{it}.png')
+    parser.add_argument('--size', type=int, default=512, help='image width and height in pixels')
+    parser.add_argument('--radius', type=float, default=1.5, help='particle radius in pixels')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--mp4', default=None, help='also encode the frames into this video')
+    parser.add_argument('--fps', type=int, default=30)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    frames = frame_io.frame_numbers(args.input, args.format)
+    start = time.perf_counter()
+    # delta frames decode forward from their keyframe, so each worker gets
+    # a consecutive run of frames and mostly steps one frame at a time
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        paths = pool.map(render, *zip(*[(args.input, args.format, it,
+                                         os.path.join(args.out, 'frame-{:05d}.png'.format(it)),
+                                         args.size, args.radius) for it in frames]),
+                         chunksize=max(1, len(frames) // (4 * args.workers)))
+        images = list(paths)
+    print('{} frames in {:.1f} seconds'.format(len(frames), time.perf_counter() - start))
+    if args.mp4 is not None:
+        encode_mp4(images, args.mp4, args.fps)
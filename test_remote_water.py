@@ -19,8 +19,20 @@ v = ti.Vector.field(2, float, n_particles)
 C = ti.Matrix.field(2, 2, float, n_particles)
 J = ti.field(float, n_particles)
 
-grid_v = ti.Vector.field(2, float, (n_grid, n_grid))
-grid_m = ti.field(float, (n_grid, n_grid))
+# 'dense' clears and updates every cell each substep; 'pointer' and
+# 'bitmasked' only activate the grid_block x grid_block blocks particles
+# scatter into, so the grid loops skip the empty part of the domain
+grid_layout = 'dense'
+grid_block = 8
+
+if grid_layout == 'dense':
+    grid_v = ti.Vector.field(2, float, (n_grid, n_grid))
+    grid_m = ti.field(float, (n_grid, n_grid))
+else:
+    grid_v = ti.Vector.field(2, float)
+    grid_m = ti.field(float)
+    grid_blocks = getattr(ti.root, grid_layout)(ti.ij, n_grid // grid_block)
+    grid_blocks.dense(ti.ij, grid_block).place(grid_v, grid_m)
 
 
 @ti.kernel
@@ -28,6 +40,10 @@ def substep():
     for i, j in grid_m:
         grid_v[i, j] = [0, 0]
         grid_m[i, j] = 0
+    if ti.static(grid_layout != 'dense'):
+        # cleared first: bitmasked blocks keep their values when deactivated
+        for I in ti.grouped(grid_blocks):
+            ti.deactivate(grid_blocks, I)
     for p in x:
         Xp = x[p] / dx
         base = int(Xp - 0.5)
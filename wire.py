@@ -0,0 +1,94 @@
+import numpy as np
+
+# Compact message layout for what main.py sends between ranks, used with
+# --wire compact. Every message is a flat uint8 buffer that starts with a
+# header of 4 int32: MAGIC, the kind, the flags and a count.
+#   halo       an (w, h, 3) strip of (m, px, py). SPARSE: count cells,
+#              int32 flat index, float32 mass, then the momentum; else all
+#              w * h cells as float32 mass then momentum. HALF sends the
+#              velocity (momentum / mass) as float16 instead of the
+#              momentum, which is too small to keep its digits in float16.
+#   particles  count particles: float32 x (2) of each, then v (2) and C
+#              (4, row major) of each, then float32 J and the particle id
+#              bits of each. HALF sends v and C as float16.
+# Strips are sent SPARSE only when that is smaller, so a halo message is
+# never longer than halo_bound of its strip.
+MAGIC = 0x4D504D57
+HALO, PARTICLES = 0, 1
+SPARSE, HALF = 1, 2
+HEADER_BYTES = 16
+
+
+def header(kind, flags, count):
+    return np.array([MAGIC, kind, flags, count], dtype=np.int32).view(np.uint8)
+
+
+def read_header(msg, kind):
+    magic, found, flags, count = np.frombuffer(msg, dtype=np.int32, count=4)
+    if magic != MAGIC or found != kind:
+        raise ValueError('not a {} message'.format('halo' if kind == HALO else 'particle'))
+    return int(flags), int(count)
+
+
+def halo_bound(shape):
+    return HEADER_BYTES + 12 * shape[0] * shape[1]
+
+
+def encode_halo(strip, half=False):
+    mass = strip[..., 0].ravel()
+    momentum = strip[..., 1:].reshape((-1, 2))
+    index = np.flatnonzero(mass).astype(np.int32)
+    cell_bytes = 8 if half else 12
+    flags = HALF if half else 0
+    if index.size * (cell_bytes + 4) < mass.size * cell_bytes:
+        flags |= SPARSE
+        mass, momentum = mass[index], momentum[index]
+    if half:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            momentum = np.where(mass[:, None] > 0, momentum / mass[:, None], 0).astype(np.float16)
+    parts = [header(HALO, flags, index.size if flags & SPARSE else mass.size)]
+    if flags & SPARSE:
+        parts.append(index.view(np.uint8))
+    parts += [mass.view(np.uint8), np.ascontiguousarray(momentum).view(np.uint8).ravel()]
+    return np.concatenate(parts)
+
+
+def decode_halo(msg, shape):
+    flags, count = read_header(msg, HALO)
+    offset = HEADER_BYTES
+    if flags & SPARSE:
+        index = np.frombuffer(msg, dtype=np.int32, count=count, offset=offset)
+        offset += 4 * count
+    mass = np.frombuffer(msg, dtype=np.float32, count=count, offset=offset)
+    offset += 4 * count
+    momentum = np.frombuffer(msg, dtype=np.float16 if flags & HALF else np.float32,
+                             count=2 * count, offset=offset).reshape((-1, 2)).astype(np.float32)
+    if flags & HALF:
+        momentum *= mass[:, None]
+    strip = np.zeros((shape[0] * shape[1], 3), dtype=np.float32)
+    cells = index if flags & SPARSE else slice(None)
+    strip[cells, 0] = mass
+    strip[cells, 1:] = momentum
+    return strip.reshape(shape)
+
+
+def encode_particles(records, half=False):
+    # records are the (n, 10) rows of x, v, C, J, id that main.py migrates
+    low = np.float16 if half else np.float32
+    parts = [header(PARTICLES, HALF if half else 0, records.shape[0])]
+    for columns, dtype in ((slice(0, 2), np.float32), (slice(2, 8), low), (slice(8, 10), np.float32)):
+        parts.append(np.ascontiguousarray(records[:, columns], dtype=dtype).view(np.uint8).ravel())
+    return np.concatenate(parts)
+
+
+def decode_particles(msg):
+    flags, count = read_header(msg, PARTICLES)
+    low = np.float16 if flags & HALF else np.float32
+    records = np.empty((count, 10), dtype=np.float32)
+    offset = HEADER_BYTES
+    for columns, dtype in ((slice(0, 2), np.float32), (slice(2, 8), low), (slice(8, 10), np.float32)):
+        width = columns.stop - columns.start
+        records[:, columns] = np.frombuffer(msg, dtype=dtype, count=count * width,
+                                            offset=offset).reshape((count, width))
+        offset += count * width * np.dtype(dtype).itemsize
+    return records